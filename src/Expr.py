@@ -1,5 +1,4 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 from typing import Any
 from lox_token import Token
 
@@ -16,6 +15,10 @@ class VisitorExpr(ABC):
     def visit_call_expr(self, expr: 'Call') -> Any:
         pass
 
+    @abstractmethod
+    def visit_compare_expr(self, expr: 'Compare') -> Any:
+        pass
+
     @abstractmethod
     def visit_get_expr(self, expr: 'Get') -> Any:
         pass
@@ -24,6 +27,10 @@ class VisitorExpr(ABC):
     def visit_grouping_expr(self, expr: 'Grouping') -> Any:
         pass
 
+    @abstractmethod
+    def visit_increment_expr(self, expr: 'Increment') -> Any:
+        pass
+
     @abstractmethod
     def visit_literal_expr(self, expr: 'Literal') -> Any:
         pass
@@ -32,6 +39,10 @@ class VisitorExpr(ABC):
     def visit_logical_expr(self, expr: 'Logical') -> Any:
         pass
 
+    @abstractmethod
+    def visit_memo_expr(self, expr: 'Memo') -> Any:
+        pass
+
     @abstractmethod
     def visit_set_expr(self, expr: 'Set') -> Any:
         pass
@@ -52,104 +63,273 @@ class VisitorExpr(ABC):
     def visit_variable_expr(self, expr: 'Variable') -> Any:
         pass
 
+# `kind` of each Expr node class
+ASSIGN_EXPR = 0
+BINARY_EXPR = 1
+CALL_EXPR = 2
+COMPARE_EXPR = 3
+GET_EXPR = 4
+GROUPING_EXPR = 5
+INCREMENT_EXPR = 6
+LITERAL_EXPR = 7
+LOGICAL_EXPR = 8
+MEMO_EXPR = 9
+SET_EXPR = 10
+SUPER_EXPR = 11
+THIS_EXPR = 12
+UNARY_EXPR = 13
+VARIABLE_EXPR = 14
+
 class Expr(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def accept(self, visitor: VisitorExpr) -> Any:
         pass
 
-@dataclass(frozen=True)
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
 class Assign(Expr):
-    name: Token
-    value: Expr
+    __slots__ = ("name", "value", "scope", "slot")
+    kind = ASSIGN_EXPR
+
+    def __init__(self, name: Token, value: Expr):
+        self.name = name
+        self.value = value
+        # filled in by the resolver, None until then
+        self.scope = None
+        self.slot = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_assign_expr(self)
 
-@dataclass(frozen=True)
+    def resolve(self, scope, slot):
+        # the only place that writes to a node after parsing
+        self.scope = scope
+        self.slot = slot
+
 class Binary(Expr):
-    left: Expr
-    operator: Token
-    right: Expr
+    __slots__ = ("left", "operator", "right", "cache")
+    kind = BINARY_EXPR
+
+    def __init__(self, left: Expr, operator: Token, right: Expr):
+        self.left = left
+        self.operator = operator
+        self.right = right
+        # filled in by the resolver, None until then
+        self.cache = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_binary_expr(self)
 
-@dataclass(frozen=True)
+    def resolve(self, cache):
+        # the only place that writes to a node after parsing
+        self.cache = cache
+
 class Call(Expr):
-    callee: Expr
-    paren: Token
-    arguments: list[Expr]
+    __slots__ = ("callee", "paren", "arguments")
+    kind = CALL_EXPR
+
+    def __init__(self, callee: Expr, paren: Token, arguments: list[Expr]):
+        self.callee = callee
+        self.paren = paren
+        self.arguments = arguments
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_call_expr(self)
 
-@dataclass(frozen=True)
+class Compare(Expr):
+    __slots__ = ("name", "operator", "constant", "scope", "slot")
+    kind = COMPARE_EXPR
+
+    def __init__(self, name: Token, operator: Token, constant: float):
+        self.name = name
+        self.operator = operator
+        self.constant = constant
+        # filled in by the resolver, None until then
+        self.scope = None
+        self.slot = None
+
+    def accept(self, visitor: VisitorExpr) -> Any:
+        return visitor.visit_compare_expr(self)
+
+    def resolve(self, scope, slot):
+        # the only place that writes to a node after parsing
+        self.scope = scope
+        self.slot = slot
+
 class Get(Expr):
-    object: Expr
-    name: Token
+    __slots__ = ("object", "name", "cache")
+    kind = GET_EXPR
+
+    def __init__(self, object: Expr, name: Token):
+        self.object = object
+        self.name = name
+        # filled in by the resolver, None until then
+        self.cache = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_get_expr(self)
 
-@dataclass(frozen=True)
+    def resolve(self, cache):
+        # the only place that writes to a node after parsing
+        self.cache = cache
+
 class Grouping(Expr):
-    expression: Expr
+    __slots__ = ("expression",)
+    kind = GROUPING_EXPR
+
+    def __init__(self, expression: Expr):
+        self.expression = expression
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_grouping_expr(self)
 
-@dataclass(frozen=True)
+class Increment(Expr):
+    __slots__ = ("name", "operator", "amount", "step", "scope", "slot")
+    kind = INCREMENT_EXPR
+
+    def __init__(self, name: Token, operator: Token, amount: float, step: float):
+        self.name = name
+        self.operator = operator
+        self.amount = amount
+        self.step = step
+        # filled in by the resolver, None until then
+        self.scope = None
+        self.slot = None
+
+    def accept(self, visitor: VisitorExpr) -> Any:
+        return visitor.visit_increment_expr(self)
+
+    def resolve(self, scope, slot):
+        # the only place that writes to a node after parsing
+        self.scope = scope
+        self.slot = slot
+
 class Literal(Expr):
-    value: Any
+    __slots__ = ("value",)
+    kind = LITERAL_EXPR
+
+    def __init__(self, value: Any):
+        self.value = value
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_literal_expr(self)
 
-@dataclass(frozen=True)
 class Logical(Expr):
-    left: Expr
-    operator: Token
-    right: Expr
+    __slots__ = ("left", "operator", "right")
+    kind = LOGICAL_EXPR
+
+    def __init__(self, left: Expr, operator: Token, right: Expr):
+        self.left = left
+        self.operator = operator
+        self.right = right
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_logical_expr(self)
 
-@dataclass(frozen=True)
+class Memo(Expr):
+    __slots__ = ("expression", "name", "scope", "slot")
+    kind = MEMO_EXPR
+
+    def __init__(self, expression: Expr, name: Token):
+        self.expression = expression
+        self.name = name
+        # filled in by the resolver, None until then
+        self.scope = None
+        self.slot = None
+
+    def accept(self, visitor: VisitorExpr) -> Any:
+        return visitor.visit_memo_expr(self)
+
+    def resolve(self, scope, slot):
+        # the only place that writes to a node after parsing
+        self.scope = scope
+        self.slot = slot
+
 class Set(Expr):
-    object: Expr
-    name: Token
-    value: Expr
+    __slots__ = ("object", "name", "value", "cache")
+    kind = SET_EXPR
+
+    def __init__(self, object: Expr, name: Token, value: Expr):
+        self.object = object
+        self.name = name
+        self.value = value
+        # filled in by the resolver, None until then
+        self.cache = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_set_expr(self)
 
-@dataclass(frozen=True)
+    def resolve(self, cache):
+        # the only place that writes to a node after parsing
+        self.cache = cache
+
 class Super(Expr):
-    keyword: Token
-    method: Token
+    __slots__ = ("keyword", "method", "upvalue", "this")
+    kind = SUPER_EXPR
+
+    def __init__(self, keyword: Token, method: Token):
+        self.keyword = keyword
+        self.method = method
+        # filled in by the resolver, None until then
+        self.upvalue = None
+        self.this = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_super_expr(self)
 
-@dataclass(frozen=True)
+    def resolve(self, upvalue, this):
+        # the only place that writes to a node after parsing
+        self.upvalue = upvalue
+        self.this = this
+
 class This(Expr):
-    keyword: Token
+    __slots__ = ("keyword", "scope", "slot")
+    kind = THIS_EXPR
+
+    def __init__(self, keyword: Token):
+        self.keyword = keyword
+        # filled in by the resolver, None until then
+        self.scope = None
+        self.slot = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_this_expr(self)
 
-@dataclass(frozen=True)
+    def resolve(self, scope, slot):
+        # the only place that writes to a node after parsing
+        self.scope = scope
+        self.slot = slot
+
 class Unary(Expr):
-    operator: Token
-    right: Expr
+    __slots__ = ("operator", "right")
+    kind = UNARY_EXPR
+
+    def __init__(self, operator: Token, right: Expr):
+        self.operator = operator
+        self.right = right
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_unary_expr(self)
 
-@dataclass(frozen=True)
 class Variable(Expr):
-    name: Token
+    __slots__ = ("name", "scope", "slot")
+    kind = VARIABLE_EXPR
+
+    def __init__(self, name: Token):
+        self.name = name
+        # filled in by the resolver, None until then
+        self.scope = None
+        self.slot = None
 
     def accept(self, visitor: VisitorExpr) -> Any:
         return visitor.visit_variable_expr(self)
 
+    def resolve(self, scope, slot):
+        # the only place that writes to a node after parsing
+        self.scope = scope
+        self.slot = slot
+
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pickle
+import sys
+import zlib
+from functools import lru_cache
+from pathlib import Path
+
+# on-disk cache of resolved syntax trees, so running the same script again
+# skips scanning, parsing, optimizing and resolving (`--cache`, it's off by
+# default).
+#
+# the caches live in a directory of the user's own, `$XDG_CACHE_HOME/pylox`
+# (`~/.cache/pylox` without it), one file per script and optimization level.
+# a cache file starts with a header (magic, the version of the front end and
+# the sha256 of the source) followed by the compressed pickle of the tree and
+# the names of the globals the resolver gave slots to. a file whose header
+# doesn't match is ignored and overwritten.
+#
+# the version of the front end is a hash of the modules that decide what the
+# cached tree looks like, so changing any of them (a new node field, an error
+# the parser reports now) invalidates every cache without anyone having to
+# remember to bump a number.
+#
+# only trees without errors are cached. the tree is stored right after
+# resolving, before any engine ran it, so the inline caches in it are still
+# empty and the same file works for every engine.
+#
+# loading a cache file unpickles it, and unpickling can run any code. the
+# header is no protection against that, anybody can compute the hash of a
+# source. that's why caches are never kept next to the script (where in a
+# shared directory like /tmp another user could plant one), only in the
+# cache directory of the user running it, created readable by them alone.
+
+MAGIC = b"LOXAST"
+CACHE_DIR = "pylox"
+
+# the modules that build the cached tree
+FRONT_END = ("lox_scanner", "lox_token", "token_type", "parser", "Expr", "stmt",
+             "optimizer", "loop_optimizer", "resolver")
+
+
+@lru_cache(maxsize=None)
+def header():
+    front_end = hashlib.sha256()
+    for module in FRONT_END:
+        front_end.update(Path(__file__).with_name(f"{module}.py").read_bytes())
+    return MAGIC + front_end.digest()
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / CACHE_DIR
+
+
+def cache_path(script_path, opt_level):
+    path = Path(script_path).resolve()
+    # scripts with the same name in different directories get their own file
+    key = hashlib.sha256(str(path).encode("utf-8")).hexdigest()[:16]
+    # the tag keeps caches of different python versions apart, pickles
+    # of one aren't guaranteed to load in the other.
+    tag = sys.implementation.cache_tag
+    return cache_dir() / f"{path.stem}-{key}.{tag}.opt{opt_level}.ast"
+
+
+def source_hash(source):
+    return hashlib.sha256(source.encode("utf-8")).digest()
+
+
+# the cached statements of `source`, or None if there is no valid cache.
+# the resolved global slots are re-created in `globals_`.
+def load(path, source, globals_):
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError:
+        return None
+
+    expected = header() + source_hash(source)
+    if not data.startswith(expected):
+        return None
+
+    try:
+        global_names, statements = pickle.loads(zlib.decompress(data[len(expected):]))
+    except Exception:
+        # truncated or from an older tree layout, just start over
+        return None
+
+    # globals get their slots in the order the resolver saw them, the ones
+    # defined already (natives) have to be where they were back then.
+    known = list(globals_.names)
+    if global_names[:len(known)] != known:
+        return None
+    for name in global_names[len(known):]:
+        globals_.intern(name)
+    return statements
+
+
+def store(path, source, globals_, statements):
+    try:
+        payload = pickle.dumps((list(globals_.names), statements), pickle.HIGHEST_PROTOCOL)
+        # trees pickle to several times the size of their source, a quick
+        # compression gets that back to about the source size.
+        payload = zlib.compress(payload, 1)
+    except (RecursionError, pickle.PicklingError, TypeError):
+        # very deeply nested code, or something in the tree that can't be
+        # pickled. not worth failing the run for, just don't cache it.
+        return
+
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # write to a temporary file and rename it, so a script running
+        # concurrently never reads a half written cache.
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temp, "wb") as file:
+            file.write(header() + source_hash(source) + payload)
+        os.replace(temp, path)
+    except OSError:
+        # read-only directory and the like, running without a cache is fine
+        pass
@@ -0,0 +1,351 @@
+from Expr import *
+from stmt import *
+from token_type import TokenType
+from chunk import *
+from environment import LOCAL, CELL, UPVALUE
+
+# lowers the resolved syntax tree into bytecode for the vm (see vm.py).
+#
+# every function (and the top level script) gets its own Chunk. variables still
+# live in Environment objects like in the tree-walker, the compiler just turns
+# the resolver's (scope, slot) into instructions so the vm never has to search for it.
+
+# (get, set) instructions for each scope a local variable can have
+VARIABLE_OPS = {
+    LOCAL: (OP_GET_LOCAL, OP_SET_LOCAL),
+    CELL: (OP_GET_CELL, OP_SET_CELL),
+    UPVALUE: (OP_GET_UPVALUE, OP_SET_UPVALUE),
+}
+
+BINARY_OPS = {
+    TokenType.BANG_EQUAL: OP_NOT_EQUAL,
+    TokenType.EQUAL_EQUAL: OP_EQUAL,
+    TokenType.GREATER: OP_GREATER,
+    TokenType.GREATER_EQUAL: OP_GREATER_EQUAL,
+    TokenType.LESS: OP_LESS,
+    TokenType.LESS_EQUAL: OP_LESS_EQUAL,
+    TokenType.MINUS: OP_SUBTRACT,
+    TokenType.PLUS: OP_ADD,
+    TokenType.SLASH: OP_DIVIDE,
+    TokenType.STAR: OP_MULTIPLY,
+}
+
+
+# book keeping for the loop we are currently compiling, so `break` knows
+# where to jump and which blocks it has to leave.
+class Loop:
+    def __init__(self, block_depth):
+        self.block_depth = block_depth # number of blocks open outside the loop
+        self.breaks = [] # offsets of jump operands to patch with the loop exit
+
+
+class BytecodeCompiler(VisitorExpr, VisitorStmt):
+    def __init__(self, interpreter, chunk=None, is_initializer=False, in_function=False, this_cell=False):
+        # the interpreter holds globals and runtime helpers
+        self.interpreter = interpreter
+        self.chunk = chunk if chunk is not None else Chunk()
+        self.is_initializer = is_initializer
+        self.in_function = in_function
+        self.this_cell = this_cell # a closure captured "this"
+
+        self.scope_depth = 0 # block scopes opened inside the current function
+        self.blocks = [] # Block statements we are in, the outermost first
+        self.loops = []
+
+    # API to use by other programs.
+
+    # compiles the whole program (or a REPL expression) into one chunk.
+    def compile_script(self, syntax):
+        if isinstance(syntax, list):
+            for statement in syntax:
+                self.compile(statement)
+            self.emit(OP_NIL)
+        else:
+            self.compile(syntax)
+        self.emit(OP_RETURN)
+        return self.chunk
+
+    def compile(self, syntax):
+        syntax.accept(self)
+
+    ##############
+    ## expressions
+    ##############
+
+    def visit_literal_expr(self, expr):
+        if expr.value is None:
+            self.emit(OP_NIL)
+        elif expr.value is True:
+            self.emit(OP_TRUE)
+        elif expr.value is False:
+            self.emit(OP_FALSE)
+        else:
+            self.emit(OP_CONSTANT, self.chunk.add_constant(expr.value))
+
+    def visit_grouping_expr(self, expr):
+        self.compile(expr.expression)
+
+    def visit_logical_expr(self, expr):
+        self.compile(expr.left)
+
+        if expr.operator.token_type == TokenType.OR:
+            end_jump = self.emit(OP_JUMP_IF_TRUE, 0)
+        else:
+            end_jump = self.emit(OP_JUMP_IF_FALSE, 0)
+
+        # left side didn't decide the result, drop it and use the right side
+        self.emit(OP_POP)
+        self.compile(expr.right)
+        self.patch_jump(end_jump)
+
+    def visit_unary_expr(self, expr):
+        self.compile(expr.right)
+
+        if expr.operator.token_type == TokenType.MINUS:
+            self.emit(OP_NEGATE, token=expr.operator)
+        else:
+            self.emit(OP_NOT)
+
+    def visit_binary_expr(self, expr):
+        self.compile(expr.left)
+        self.compile(expr.right)
+        self.emit(BINARY_OPS[expr.operator.token_type], token=expr.operator)
+
+    def visit_call_expr(self, expr):
+        if isinstance(expr.callee, Get):
+            # `obj.method(args)`, invoked without creating a bound method.
+            # the method is looked up before the arguments are evaluated,
+            # like in the tree-walker.
+            self.compile(expr.callee.object)
+            self.emit(OP_GET_METHOD, self.chunk.add_constant(expr.callee))
+            for argument in expr.arguments:
+                self.compile(argument)
+            self.emit(OP_INVOKE, len(expr.arguments), token=expr.paren)
+            return
+
+        self.compile(expr.callee)
+        for argument in expr.arguments:
+            self.compile(argument)
+        self.emit(OP_CALL, len(expr.arguments), token=expr.paren)
+
+    def visit_variable_expr(self, expr):
+        self.get_variable(expr, expr.name)
+
+    def visit_assign_expr(self, expr):
+        self.compile(expr.value)
+        self.set_variable(expr, expr.name)
+
+    def visit_increment_expr(self, expr):
+        if expr.scope != LOCAL:
+            # globals and captured variables take the long way
+            self.get_variable(expr, expr.name)
+            self.emit(OP_CONSTANT, self.chunk.add_constant(expr.amount))
+            self.emit(BINARY_OPS[expr.operator.token_type], token=expr.operator)
+            self.set_variable(expr, expr.name)
+            return
+
+        self.emit(OP_INCREMENT_LOCAL, expr.slot,
+                  self.chunk.add_constant(expr), token=expr.operator)
+
+    def visit_compare_expr(self, expr):
+        comparison = BINARY_OPS[expr.operator.token_type]
+        if expr.scope != LOCAL:
+            self.get_variable(expr, expr.name)
+            self.emit(OP_CONSTANT, self.chunk.add_constant(expr.constant))
+            self.emit(comparison, token=expr.operator)
+            return
+
+        self.emit(OP_COMPARE_LOCAL, expr.slot, comparison,
+                  self.chunk.add_constant(expr.constant), token=expr.operator)
+
+    def visit_memo_expr(self, expr):
+        # hidden variables are always locals of the function the loop is in
+        done = self.emit(OP_GET_MEMO, expr.slot, 0)
+        # not computed yet: drop the unset value, compute and store it
+        self.emit(OP_POP)
+        self.compile(expr.expression)
+        self.emit(OP_SET_LOCAL, expr.slot)
+        self.patch_jump(done)
+
+    def visit_get_expr(self, expr):
+        self.compile(expr.object)
+        # the node itself goes into the constants, it carries the name and
+        # the inline cache of this property access
+        self.emit(OP_GET_PROPERTY, self.chunk.add_constant(expr))
+
+    def visit_set_expr(self, expr):
+        set_ = self.chunk.add_constant(expr)
+        self.compile(expr.object)
+        self.emit(OP_CHECK_INSTANCE, set_)
+        self.compile(expr.value)
+        self.emit(OP_SET_PROPERTY, set_)
+
+    def visit_super_expr(self, expr):
+        self.compile(expr.this)
+        self.emit(OP_GET_SUPER, expr.upvalue, self.chunk.add_constant(expr.method))
+
+    def visit_this_expr(self, expr):
+        self.get_variable(expr, expr.keyword)
+
+    #############
+    ## statement
+    #############
+
+    def visit_expression_stmt(self, stmt):
+        self.compile(stmt.expression)
+        self.emit(OP_POP)
+
+    def visit_print_stmt(self, stmt):
+        self.compile(stmt.expression)
+        self.emit(OP_PRINT)
+
+    def visit_var_stmt(self, stmt):
+        if stmt.initializer is not None:
+            self.compile(stmt.initializer)
+        else:
+            self.emit(OP_NIL)
+        if stmt.cell:
+            self.emit(OP_DEFINE_CELL)
+        else:
+            self.define(stmt.name)
+
+    def visit_block_stmt(self, stmt):
+        self.blocks.append(stmt)
+        if stmt.inline:
+            # runs in the current scope, see Resolver.visit_block_stmt
+            for statement in stmt.statements:
+                self.compile(statement)
+        else:
+            self.emit(OP_PUSH_SCOPE)
+            self.scope_depth += 1
+            for statement in stmt.statements:
+                self.compile(statement)
+            self.scope_depth -= 1
+        self.blocks.pop()
+        self.leave_block(stmt)
+
+    def visit_if_stmt(self, stmt):
+        self.compile(stmt.condition)
+        else_jump = self.emit(OP_POP_JUMP_IF_FALSE, 0)
+        self.compile(stmt.then_branch)
+
+        if stmt.else_branch is None:
+            self.patch_jump(else_jump)
+            return
+
+        end_jump = self.emit(OP_JUMP, 0)
+        self.patch_jump(else_jump)
+        self.compile(stmt.else_branch)
+        self.patch_jump(end_jump)
+
+    def visit_while_stmt(self, stmt):
+        loop_start = len(self.chunk.code)
+        self.compile(stmt.condition)
+        exit_jump = self.emit(OP_POP_JUMP_IF_FALSE, 0)
+
+        loop = Loop(len(self.blocks))
+        self.loops.append(loop)
+        self.compile(stmt.body)
+        self.loops.pop()
+
+        self.emit(OP_JUMP, loop_start)
+        self.patch_jump(exit_jump)
+        for offset in loop.breaks:
+            self.patch_jump(offset)
+
+    # the parser makes sure a `break` is inside a loop of its own function
+    def visit_break_stmt(self, stmt):
+        loop = self.loops[-1]
+        for block in reversed(self.blocks[loop.block_depth:]):
+            self.leave_block(block)
+        loop.breaks.append(self.emit(OP_JUMP, 0))
+
+    def visit_return_stmt(self, stmt):
+        if stmt.value is None:
+            self.emit_return()
+            return
+
+        self.compile(stmt.value)
+        self.emit(OP_RETURN)
+
+    def visit_function_stmt(self, stmt):
+        proto = self.function(stmt, False)
+        if stmt.cell:
+            self.emit(OP_NEW_CELL)
+            self.emit(OP_CLOSURE, self.chunk.add_constant(proto))
+            self.emit(OP_FILL_CELL)
+            return
+
+        self.emit(OP_CLOSURE, self.chunk.add_constant(proto))
+        self.define(stmt.name)
+
+    def visit_class_stmt(self, stmt):
+        if stmt.cell:
+            self.emit(OP_NEW_CELL)
+        if stmt.superclass is not None:
+            self.compile(stmt.superclass)
+
+        methods = []
+        for method in stmt.methods:
+            methods.append(self.function(method, method.name.lexeme == "init"))
+
+        proto = ClassProto(stmt, methods)
+        token = stmt.superclass.name if stmt.superclass is not None else None
+        self.emit(OP_CLASS, self.chunk.add_constant(proto), token=token)
+        if stmt.cell:
+            self.emit(OP_FILL_CELL)
+        else:
+            self.define(stmt.name)
+
+    ####################
+    ## helper functions
+    ####################
+
+    def emit(self, op, *operands, token=None):
+        return self.chunk.write(op, *operands, token=token)
+
+    # points a forward jump at the current end of the chunk.
+    def patch_jump(self, offset):
+        self.chunk.patch(offset, len(self.chunk.code))
+
+    def emit_return(self):
+        if self.is_initializer:
+            # initializers always return `this`, from the first slot
+            self.emit(OP_GET_CELL if self.this_cell else OP_GET_LOCAL, 0)
+        else:
+            self.emit(OP_NIL)
+        self.emit(OP_RETURN)
+
+    def leave_block(self, stmt):
+        if not stmt.inline:
+            self.emit(OP_POP_SCOPE)
+        elif stmt.start is not None:
+            self.emit(OP_TRUNCATE, stmt.start)
+
+    def function(self, declaration, is_initializer):
+        compiler = BytecodeCompiler(self.interpreter, Chunk(), is_initializer, True,
+                                    0 in declaration.cells)
+        for statement in declaration.body:
+            compiler.compile(statement)
+        compiler.emit_return()
+        return FunctionProto(declaration, compiler.chunk, is_initializer)
+
+    def get_variable(self, expr, name_token):
+        if expr.scope is None:
+            self.emit(OP_GET_GLOBAL, expr.slot, token=name_token)
+        else:
+            self.emit(VARIABLE_OPS[expr.scope][0], expr.slot)
+
+    def set_variable(self, expr, name_token):
+        if expr.scope is None:
+            self.emit(OP_SET_GLOBAL, expr.slot, token=name_token)
+        else:
+            self.emit(VARIABLE_OPS[expr.scope][1], expr.slot)
+
+    # pops the value on top of the stack into a new variable.
+    def define(self, name_token):
+        if self.in_function or self.scope_depth > 0:
+            # locals are defined by appending, see Environment
+            self.emit(OP_DEFINE_LOCAL)
+        else:
+            self.emit(OP_DEFINE_GLOBAL, self.interpreter.globals_.intern(name_token.lexeme))
@@ -0,0 +1,162 @@
+from array import array
+
+# opcodes of the bytecode vm. they are plain ints (and not an Enum like
+# TokenType) because comparing enum members in the vm dispatch loop is a lot
+# slower than comparing small ints.
+#
+# operands follow the opcode directly in the instruction stream, the comment
+# next to each opcode lists them.
+
+OP_CONSTANT = 0          # const index
+OP_NIL = 1
+OP_TRUE = 2
+OP_FALSE = 3
+OP_POP = 4
+OP_GET_LOCAL = 5         # slot
+OP_SET_LOCAL = 6         # slot
+OP_GET_GLOBAL = 7        # global slot
+OP_SET_GLOBAL = 8        # global slot
+OP_DEFINE_GLOBAL = 9     # global slot
+OP_GET_PROPERTY = 10     # Get node const index
+OP_SET_PROPERTY = 11     # Set node const index
+OP_GET_SUPER = 12        # upvalue index of super, method token const index. pops "this"
+OP_EQUAL = 13
+OP_NOT_EQUAL = 14
+OP_GREATER = 15
+OP_GREATER_EQUAL = 16
+OP_LESS = 17
+OP_LESS_EQUAL = 18
+OP_ADD = 19
+OP_SUBTRACT = 20
+OP_MULTIPLY = 21
+OP_DIVIDE = 22
+OP_NOT = 23
+OP_NEGATE = 24
+OP_PRINT = 25
+OP_JUMP = 26             # target offset
+OP_JUMP_IF_FALSE = 27    # target offset, leaves condition on the stack
+OP_JUMP_IF_TRUE = 28     # target offset, leaves condition on the stack
+OP_POP_JUMP_IF_FALSE = 29  # target offset
+OP_CALL = 30             # argument count
+OP_RETURN = 31
+OP_CLOSURE = 32          # function const index
+OP_CLASS = 33            # class const index, pushes the new class
+OP_PUSH_SCOPE = 34
+OP_POP_SCOPE = 35
+OP_DEFINE_LOCAL = 36     # appends to the current environment, see Environment
+OP_INVOKE = 37           # argument count, calls what OP_GET_METHOD pushed
+# superinstructions for counted loops, see Increment and Compare in the Optimizer
+OP_INCREMENT_LOCAL = 38  # slot, Increment node const index
+OP_COMPARE_LOCAL = 39    # slot, comparison opcode, number const index
+# pushes the value of a Memo's hidden variable and jumps to the target if it
+# was computed already, see LoopOptimizer
+OP_GET_MEMO = 40         # slot, target offset
+# drops the variables of a block that has no scope of its own, see
+# Resolver.visit_block_stmt
+OP_TRUNCATE = 41         # first slot of the block
+# captured variables, see Cell in environment.py
+OP_GET_CELL = 42         # slot
+OP_SET_CELL = 43         # slot
+OP_GET_UPVALUE = 44      # upvalue index
+OP_SET_UPVALUE = 45      # upvalue index
+OP_DEFINE_CELL = 46      # appends the popped value in a new cell
+# a captured function or class needs its cell before it exists, so its
+# methods (or itself) can capture it: NEW_CELL appends an empty cell and
+# pushes it too, FILL_CELL pops the value and stores it in the cell below.
+OP_NEW_CELL = 47
+OP_FILL_CELL = 48
+# first half of `obj.method(args)`: pops the object and pushes the method and
+# the object, or the value of the property and nil when it's not a method of
+# the object. the arguments go on top of that and then OP_INVOKE calls it.
+OP_GET_METHOD = 49       # Get node const index
+# `obj.field = value` checks the object before the value is evaluated
+OP_CHECK_INSTANCE = 50   # Set node const index, for the error
+
+# names for debugging / disassembling
+OP_NAMES = {value: name for name, value in globals().items() if name.startswith("OP_")}
+
+
+class Chunk:
+    def __init__(self):
+        # instruction stream, opcodes and their operands
+        self.code = array("i")
+        # literal values, tokens and function / class prototypes
+        self.constants = []
+        # instruction offset -> token, only for instructions which can fail
+        # at runtime. used for reporting the line of a LoxRuntimeError.
+        self.tokens = {}
+
+    def write(self, op, *operands, token=None):
+        if token is not None:
+            self.tokens[len(self.code)] = token
+        self.code.append(op)
+        self.code.extend(operands)
+        # offset of the last operand, handy for patching jumps.
+        return len(self.code) - 1
+
+    def add_constant(self, value):
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+    def patch(self, offset, value):
+        self.code[offset] = value
+
+    def disassemble(self, name):
+        lines = [f"== {name} =="]
+        offset = 0
+        while offset < len(self.code):
+            op = self.code[offset]
+            operands = OPERANDS.get(op, 0)
+            args = list(self.code[offset + 1: offset + 1 + operands])
+            lines.append(f"{offset:04d} {OP_NAMES[op]:<20} {' '.join(map(str, args))}")
+            offset += 1 + operands
+        return "\n".join(lines)
+
+
+# number of operands for each opcode which has any
+OPERANDS = {
+    OP_CONSTANT: 1,
+    OP_GET_LOCAL: 1,
+    OP_SET_LOCAL: 1,
+    OP_GET_CELL: 1,
+    OP_SET_CELL: 1,
+    OP_GET_UPVALUE: 1,
+    OP_SET_UPVALUE: 1,
+    OP_GET_GLOBAL: 1,
+    OP_SET_GLOBAL: 1,
+    OP_DEFINE_GLOBAL: 1,
+    OP_GET_PROPERTY: 1,
+    OP_SET_PROPERTY: 1,
+    OP_GET_SUPER: 2,
+    OP_JUMP: 1,
+    OP_JUMP_IF_FALSE: 1,
+    OP_JUMP_IF_TRUE: 1,
+    OP_POP_JUMP_IF_FALSE: 1,
+    OP_CALL: 1,
+    OP_INVOKE: 1,
+    OP_GET_METHOD: 1,
+    OP_CHECK_INSTANCE: 1,
+    OP_INCREMENT_LOCAL: 2,
+    OP_COMPARE_LOCAL: 3,
+    OP_GET_MEMO: 2,
+    OP_TRUNCATE: 1,
+    OP_CLOSURE: 1,
+    OP_CLASS: 1,
+}
+
+
+# compiled function, not yet closed over an environment. OP_CLOSURE turns it
+# into a runtime function value.
+class FunctionProto:
+    def __init__(self, declaration, chunk, is_initializer):
+        self.declaration = declaration
+        self.chunk = chunk
+        self.is_initializer = is_initializer
+        self.params = [param.lexeme for param in declaration.params]
+
+
+# compiled class declaration, OP_CLASS turns it into a LoxClass.
+class ClassProto:
+    def __init__(self, declaration, methods):
+        self.declaration = declaration
+        self.methods = methods # list of FunctionProto
@@ -0,0 +1,784 @@
+import operator
+
+from Expr import *
+from stmt import *
+from token_type import TokenType
+from lox_runtime_error import LoxRuntimeError
+from environment import Environment, Cell, UNDEFINED, LOCAL, CELL, capture, box
+from lox_function import LoxFunction, LoxCallable, TailCall
+from lox_class import LoxClass, LoxInstance
+from interpreter import Interpreter, BREAK
+from loop_optimizer import UNSET
+
+# closure compilation backend.
+#
+# instead of walking the tree on every execution (accept() -> visit_*() for
+# every single node), we walk the resolved tree exactly once and turn every
+# node into a plain python function. expression nodes become `fn(env) -> value`
+# and statement nodes become `fn(env) -> completion`. everything that can be
+# decided statically (which operator to apply, whether a variable is a plain
+# local, a cell or an upvalue, ...) is decided while compiling, so the
+# generated closures only do the actual work.
+
+# compiled statements return the same completion values as the statements of
+# the tree-walker, see BREAK in interpreter.py.
+
+# operators that only work on numbers (and on strings by length, for the
+# comparisons). the actual semantics live in Interpreter.binary_operation, the
+# closures below only inline the number/number case.
+ARITHMETIC = {
+    TokenType.MINUS: operator.sub,
+    TokenType.STAR: operator.mul,
+}
+
+COMPARISON = {
+    TokenType.GREATER: operator.gt,
+    TokenType.GREATER_EQUAL: operator.ge,
+    TokenType.LESS: operator.lt,
+    TokenType.LESS_EQUAL: operator.le,
+}
+
+
+# runs TailCall completions until one of them really returns, see TailCall.
+def run_tail_calls(tail_call):
+    while True:
+        function = tail_call.function
+        if function.cells:
+            box(tail_call.values, function.cells)
+        completion = function.body(Environment(tail_call.values, function.upvalues))
+        if completion is None:
+            return None
+        if type(completion) is tuple:
+            return completion[0]
+        tail_call = completion
+
+
+class CompiledFunction(LoxFunction):
+    def __init__(self, declaration, upvalues, is_initializer, body, params, this=None):
+        super().__init__(declaration, upvalues, is_initializer, this)
+        # compiled function body and parameter names, shared by every
+        # closure (and bound method) created from the same declaration.
+        self.body = body
+        self.params = params
+        self.cells = declaration.cells
+
+    def call(self, interpreter, arguments):
+        if self.this is not None:
+            return self.call_method(interpreter, self.this, arguments)
+
+        values = list(arguments)
+        if self.cells:
+            box(values, self.cells)
+        completion = self.body(Environment(values, self.upvalues))
+
+        if completion is None:
+            return None
+        if type(completion) is tuple:
+            return completion[0]
+        return run_tail_calls(completion)
+
+    def call_method(self, interpreter, instance, arguments):
+        values = [instance] # "this"
+        values.extend(arguments)
+        if self.cells:
+            box(values, self.cells)
+        completion = self.body(Environment(values, self.upvalues))
+
+        if self.is_initializer:
+            return instance
+        if completion is None:
+            return None
+        if type(completion) is tuple:
+            return completion[0]
+        return run_tail_calls(completion)
+
+    def bind(self, instance):
+        return CompiledFunction(self.declaration, self.upvalues, self.is_initializer,
+                                self.body, self.params, instance)
+
+    def arity(self):
+        return len(self.params)
+
+
+class ClosureCompiler(VisitorExpr, VisitorStmt):
+    def __init__(self, interpreter):
+        # the interpreter owns globals and the helpers
+        # (stringify, binary_operation, ...) the compiled code falls back on.
+        self.interpreter = interpreter
+        # how many scopes deep we are, 0 means declarations are globals
+        self.scope_depth = 0
+
+    # API to use by other programs.
+    def compile(self, syntax):
+        return syntax.accept(self)
+
+    ##############
+    ## expressions
+    ##############
+
+    def visit_literal_expr(self, expr):
+        value = expr.value
+        return lambda env: value
+
+    def visit_grouping_expr(self, expr):
+        # grouping only matters to the parser, at runtime it's just its inner expression.
+        return self.compile(expr.expression)
+
+    def visit_logical_expr(self, expr):
+        left = self.compile(expr.left)
+        right = self.compile(expr.right)
+
+        if expr.operator.token_type == TokenType.OR:
+            def logical_or(env):
+                value = left(env)
+                if value is None or value is False:
+                    return right(env)
+                return value
+            return logical_or
+
+        def logical_and(env):
+            value = left(env)
+            if value is None or value is False:
+                return value
+            return right(env)
+        return logical_and
+
+    def visit_unary_expr(self, expr):
+        right = self.compile(expr.right)
+        operator_token = expr.operator
+
+        if operator_token.token_type == TokenType.MINUS:
+            def negate(env):
+                value = right(env)
+                if type(value) is float:
+                    return -value
+                raise LoxRuntimeError(operator_token, "Operand must be a number.")
+            return negate
+
+        def bang(env):
+            value = right(env)
+            return value is None or value is False
+        return bang
+
+    def visit_binary_expr(self, expr):
+        left = self.compile(expr.left)
+        right = self.compile(expr.right)
+        operator_token = expr.operator
+        token_type = operator_token.token_type
+        # slow path, handles strings, mixed operands and runtime errors
+        binary_operation = self.interpreter.binary_operation
+
+        # `n - 1`, `i < 10`... are common enough to skip evaluating the literal.
+        constant = isinstance(expr.right, Literal) and type(expr.right.value) is float
+        value = expr.right.value if constant else None
+
+        if token_type in ARITHMETIC or token_type in COMPARISON:
+            op = ARITHMETIC.get(token_type) or COMPARISON.get(token_type)
+
+            if constant:
+                def number_op_constant(env):
+                    a = left(env)
+                    if type(a) is float:
+                        return op(a, value)
+                    return binary_operation(operator_token, a, value)
+                return number_op_constant
+
+            def number_op(env):
+                a = left(env)
+                b = right(env)
+                if type(a) is float and type(b) is float:
+                    return op(a, b)
+                return binary_operation(operator_token, a, b)
+            return number_op
+
+        if token_type == TokenType.PLUS:
+            if constant:
+                def add_constant(env):
+                    a = left(env)
+                    if type(a) is float:
+                        return a + value
+                    return binary_operation(operator_token, a, value)
+                return add_constant
+
+            def add(env):
+                a = left(env)
+                b = right(env)
+                if type(a) is float and type(b) is float:
+                    return a + b
+                return binary_operation(operator_token, a, b)
+            return add
+
+        if token_type == TokenType.EQUAL_EQUAL:
+            return lambda env: left(env) == right(env)
+        if token_type == TokenType.BANG_EQUAL:
+            return lambda env: left(env) != right(env)
+
+        # division (and its division by zero check) stays on the generic path.
+        def generic(env):
+            a = left(env)
+            b = right(env)
+            return binary_operation(operator_token, a, b)
+        return generic
+
+    def visit_call_expr(self, expr):
+        if isinstance(expr.callee, Get):
+            return self.method_call(expr)
+
+        callee = self.compile(expr.callee)
+        arguments = [self.compile(argument) for argument in expr.arguments]
+        paren = expr.paren
+        interpreter = self.interpreter
+
+        def call(env):
+            function = callee(env)
+            values = [argument(env) for argument in arguments]
+
+            # fast path: plain lox function, run the compiled body directly.
+            if type(function) is CompiledFunction and function.this is None:
+                params = function.params
+                if len(values) != len(params):
+                    raise LoxRuntimeError(paren, f"Expected {len(params)} arguments but got {len(values)}.")
+                if function.cells:
+                    box(values, function.cells)
+                # params take the first slots, the list is ours to keep
+                completion = function.body(Environment(values, function.upvalues))
+                if completion is None:
+                    return None
+                if type(completion) is tuple:
+                    return completion[0]
+                return run_tail_calls(completion)
+
+            if not isinstance(function, LoxCallable):
+                raise LoxRuntimeError(paren, "Can only call functions and classes.")
+            if len(values) != function.arity():
+                raise LoxRuntimeError(paren, f"Expected {function.arity()} arguments but got {len(values)}.")
+            return function.call(interpreter, values)
+        return call
+
+    def visit_variable_expr(self, expr):
+        return self.variable_getter(expr, expr.name)
+
+    def visit_assign_expr(self, expr):
+        value = self.compile(expr.value)
+        name_token = expr.name
+
+        if expr.scope is None:
+            values = self.interpreter.globals_.values
+            slot = expr.slot
+            def assign_global(env):
+                result = value(env)
+                if values[slot] is UNDEFINED:
+                    raise LoxRuntimeError(name_token, f"Undefined variable '{name_token.lexeme}'.")
+                values[slot] = result
+                return result
+            return assign_global
+
+        slot = expr.slot
+        if expr.scope == LOCAL:
+            def assign_local(env):
+                result = value(env)
+                env.values[slot] = result
+                return result
+            return assign_local
+
+        if expr.scope == CELL:
+            def assign_cell(env):
+                result = value(env)
+                env.values[slot].value = result
+                return result
+            return assign_cell
+
+        def assign_upvalue(env):
+            result = value(env)
+            env.upvalues[slot].value = result
+            return result
+        return assign_upvalue
+
+    # `i = i + <number>`, fused by the Optimizer.
+    def visit_increment_expr(self, expr):
+        name_token = expr.name
+        operator_token = expr.operator
+        amount = expr.amount
+        step = expr.step
+        slot = expr.slot
+        binary_operation = self.interpreter.binary_operation
+
+        if expr.scope is None:
+            values = self.interpreter.globals_.values
+            def increment_global(env):
+                value = values[slot]
+                if value is UNDEFINED:
+                    raise LoxRuntimeError(name_token, f"Undefined variable '{name_token.lexeme}'.")
+                if type(value) is float:
+                    value += step
+                else:
+                    value = binary_operation(operator_token, value, amount)
+                values[slot] = value
+                return value
+            return increment_global
+
+        if expr.scope == LOCAL:
+            def increment(env):
+                values = env.values
+                value = values[slot]
+                if type(value) is float:
+                    value += step
+                else:
+                    value = binary_operation(operator_token, value, amount)
+                values[slot] = value
+                return value
+            return increment
+
+        # a captured variable, the cell is in the values or the upvalues
+        upvalue = expr.scope != CELL
+        def increment_cell(env):
+            cell = env.upvalues[slot] if upvalue else env.values[slot]
+            value = cell.value
+            if type(value) is float:
+                value += step
+            else:
+                value = binary_operation(operator_token, value, amount)
+            cell.value = value
+            return value
+        return increment_cell
+
+    # `i < <number>` (or >, <=, >=), fused by the Optimizer.
+    def visit_compare_expr(self, expr):
+        variable = self.variable_getter(expr, expr.name)
+        compare = COMPARISON[expr.operator.token_type]
+        operator_token = expr.operator
+        constant = expr.constant
+        binary_operation = self.interpreter.binary_operation
+
+        if expr.operator.token_type == TokenType.LESS and expr.scope == LOCAL:
+            slot = expr.slot
+            def less_local(env):
+                value = env.values[slot]
+                if type(value) is float:
+                    return value < constant
+                return binary_operation(operator_token, value, constant)
+            return less_local
+
+        def compare_(env):
+            value = variable(env)
+            if type(value) is float:
+                return compare(value, constant)
+            return binary_operation(operator_token, value, constant)
+        return compare_
+
+    # loop invariant expression, see LoopOptimizer.
+    def visit_memo_expr(self, expr):
+        expression = self.compile(expr.expression)
+        slot = expr.slot
+
+        # hidden variables are always locals of the function the loop is in
+        def memo(env):
+            values = env.values
+            value = values[slot]
+            if value is UNSET:
+                value = expression(env)
+                values[slot] = value
+            return value
+        return memo
+
+    def visit_get_expr(self, expr):
+        obj = self.compile(expr.object)
+        name = expr.name
+        cache = expr.cache
+
+        def get(env):
+            instance = obj(env)
+            if isinstance(instance, LoxInstance):
+                # cache hit on a field, the common case
+                if cache.shape is instance.shape and cache.index is not None:
+                    return instance.values[cache.index]
+                return cache.get(instance, name)
+            raise LoxRuntimeError(name, "Only instances have properties.")
+        return get
+
+    def visit_set_expr(self, expr):
+        obj = self.compile(expr.object)
+        value = self.compile(expr.value)
+        name = expr.name
+        cache = expr.cache
+
+        def set_(env):
+            instance = obj(env)
+            if not isinstance(instance, LoxInstance):
+                raise LoxRuntimeError(name, "Only instances have fields.")
+            result = value(env)
+            cache.set(instance, name, result)
+            return result
+        return set_
+
+    def visit_super_expr(self, expr):
+        upvalue = expr.upvalue
+        this = self.compile(expr.this)
+        method_token = expr.method
+
+        def super_(env):
+            superclass = env.upvalues[upvalue].value
+            obj = this(env)
+            method = superclass.find_method(method_token.lexeme)
+
+            if method is None:
+                raise LoxRuntimeError(method_token,
+                                      "Undefined property '" + method_token.lexeme + "'.")
+            return method.bind(obj)
+        return super_
+
+    def visit_this_expr(self, expr):
+        return self.variable_getter(expr, expr.keyword)
+
+    #############
+    ## statement
+    #############
+
+    def visit_expression_stmt(self, stmt):
+        expression = self.compile(stmt.expression)
+
+        def expression_stmt(env):
+            expression(env)
+        return expression_stmt
+
+    def visit_print_stmt(self, stmt):
+        expression = self.compile(stmt.expression)
+        interpreter = self.interpreter
+        stringify = interpreter.stringify
+
+        def print_stmt(env):
+            interpreter.output.write_line(stringify(expression(env)))
+        return print_stmt
+
+    def visit_var_stmt(self, stmt):
+        name = stmt.name.lexeme
+        initializer = None
+        if stmt.initializer is not None:
+            initializer = self.compile(stmt.initializer)
+
+        if self.scope_depth == 0:
+            values = self.interpreter.globals_.values
+            slot = self.interpreter.globals_.intern(name)
+            def var_global(env):
+                values[slot] = initializer(env) if initializer is not None else None
+            return var_global
+
+        # locals are defined by appending, see Environment
+        if stmt.cell:
+            if initializer is None:
+                return lambda env: env.values.append(Cell(None))
+            return lambda env: env.values.append(Cell(initializer(env)))
+        if initializer is None:
+            return lambda env: env.values.append(None)
+        return lambda env: env.values.append(initializer(env))
+
+    def visit_block_stmt(self, stmt):
+        if stmt.inline:
+            # runs in the current environment, see Resolver.visit_block_stmt
+            body = self.compile_block(stmt.statements)
+            start = stmt.start
+            if start is None:
+                return body
+
+            def inline_block(env):
+                completion = body(env)
+                del env.values[start:]
+                return completion
+            return inline_block
+
+        # a block at the top level, see Resolver.visit_block_stmt
+        self.scope_depth += 1
+        body = self.compile_block(stmt.statements)
+        self.scope_depth -= 1
+        return lambda env: body(Environment([]))
+
+    def visit_if_stmt(self, stmt):
+        condition = self.compile(stmt.condition)
+        then_branch = self.compile(stmt.then_branch)
+
+        if stmt.else_branch is None:
+            def if_stmt(env):
+                value = condition(env)
+                if value is None or value is False:
+                    return None
+                return then_branch(env)
+            return if_stmt
+
+        else_branch = self.compile(stmt.else_branch)
+        def if_else_stmt(env):
+            value = condition(env)
+            if value is None or value is False:
+                return else_branch(env)
+            return then_branch(env)
+        return if_else_stmt
+
+    def visit_while_stmt(self, stmt):
+        condition = self.compile(stmt.condition)
+        body = self.compile(stmt.body)
+
+        def while_stmt(env):
+            while True:
+                value = condition(env)
+                if value is None or value is False:
+                    return None
+                completion = body(env)
+                if completion is not None:
+                    if completion is BREAK:
+                        return None
+                    return completion
+        return while_stmt
+
+    def visit_break_stmt(self, stmt):
+        return lambda env: BREAK
+
+    def visit_return_stmt(self, stmt):
+        if stmt.tail_call:
+            return self.tail_call(stmt.value)
+
+        if stmt.value is None:
+            return lambda env: (None,)
+
+        value = self.compile(stmt.value)
+        return lambda env: (value(env),)
+
+    def visit_function_stmt(self, stmt):
+        body = self.compile_function(stmt)
+        params = [param.lexeme for param in stmt.params]
+        upvalues = stmt.upvalues
+
+        if stmt.cell:
+            def function_cell_stmt(env):
+                # the cell has to exist before the function can capture it
+                cell = Cell(None)
+                env.values.append(cell)
+                cell.value = CompiledFunction(stmt, capture(env, upvalues), False, body, params)
+            return function_cell_stmt
+
+        define = self.definer(stmt.name)
+        def function_stmt(env):
+            define(env, CompiledFunction(stmt, capture(env, upvalues), False, body, params))
+        return function_stmt
+
+    def visit_class_stmt(self, stmt):
+        name = stmt.name.lexeme
+        superclass_name = stmt.superclass
+        superclass_getter = None
+        if superclass_name is not None:
+            superclass_getter = self.compile(superclass_name)
+
+        methods = []
+        for method in stmt.methods:
+            methods.append((method,
+                            method.name.lexeme == "init",
+                            self.compile_function(method),
+                            [param.lexeme for param in method.params]))
+
+        define = self.definer(stmt.name)
+        is_cell = stmt.cell
+        upvalues = stmt.upvalues
+
+        def class_stmt(env):
+            superclass = None
+            if superclass_getter is not None:
+                superclass = superclass_getter(env)
+                if not isinstance(superclass, LoxClass):
+                    raise LoxRuntimeError(superclass_name.name,
+                                          "Superclass must be a name.")
+
+            if is_cell:
+                # the methods capture the class, so its cell comes first
+                cell = Cell(None)
+                env.values.append(cell)
+
+            method_env = env
+            if superclass is not None:
+                method_env = Environment([Cell(superclass)], capture(env, upvalues))
+
+            functions = {}
+            for declaration, is_initializer, body, params in methods:
+                functions[declaration.name.lexeme] = CompiledFunction(
+                    declaration, capture(method_env, declaration.upvalues),
+                    is_initializer, body, params)
+
+            klass = LoxClass(name, superclass, functions)
+            if is_cell:
+                cell.value = klass
+            else:
+                define(env, klass)
+        return class_stmt
+
+    ####################
+    ## helper functions
+    ####################
+
+    # `obj.method(args)`, calls the method without creating a bound method.
+    def method_call(self, expr):
+        get = expr.callee
+        obj = self.compile(get.object)
+        arguments = [self.compile(argument) for argument in expr.arguments]
+        name = get.name
+        cache = get.cache
+        paren = expr.paren
+        interpreter = self.interpreter
+
+        def method_call(env):
+            instance = obj(env)
+
+            if isinstance(instance, LoxInstance):
+                method = cache.method_of(instance, name)
+            else:
+                method = None
+
+            if method is not None:
+                values = [argument(env) for argument in arguments]
+                if len(values) != len(method.params):
+                    raise LoxRuntimeError(paren, f"Expected {len(method.params)} arguments but got {len(values)}.")
+                return method.call_method(interpreter, instance, values)
+
+            # a field or not an instance at all
+            function = interpreter.get_property(get, instance)
+            values = [argument(env) for argument in arguments]
+            if not isinstance(function, LoxCallable):
+                raise LoxRuntimeError(paren, "Can only call functions and classes.")
+            if len(values) != function.arity():
+                raise LoxRuntimeError(paren, f"Expected {function.arity()} arguments but got {len(values)}.")
+            return function.call(interpreter, values)
+        return method_call
+
+    # `return callee(args)` in tail position, compiled into a statement that
+    # returns a TailCall completion for compiled functions and calls anything
+    # else (natives, classes, initializers) right away.
+    def tail_call(self, expr):
+        arguments = [self.compile(argument) for argument in expr.arguments]
+        paren = expr.paren
+        interpreter = self.interpreter
+
+        def tail_call(function, values):
+            if type(function) is CompiledFunction and function.this is None:
+                params = function.params
+                if len(values) != len(params):
+                    raise LoxRuntimeError(paren, f"Expected {len(params)} arguments but got {len(values)}.")
+                return TailCall(function, values)
+
+            if not isinstance(function, LoxCallable):
+                raise LoxRuntimeError(paren, "Can only call functions and classes.")
+            if len(values) != function.arity():
+                raise LoxRuntimeError(paren, f"Expected {function.arity()} arguments but got {len(values)}.")
+            return (function.call(interpreter, values),)
+
+        if not isinstance(expr.callee, Get):
+            callee = self.compile(expr.callee)
+
+            def tail_function_call(env):
+                function = callee(env)
+                return tail_call(function, [argument(env) for argument in arguments])
+            return tail_function_call
+
+        get = expr.callee
+        obj = self.compile(get.object)
+        name = get.name
+        cache = get.cache
+
+        def tail_method_call(env):
+            instance = obj(env)
+            if isinstance(instance, LoxInstance):
+                method = cache.method_of(instance, name)
+            else:
+                method = None
+
+            if method is not None:
+                values = [argument(env) for argument in arguments]
+                if len(values) != len(method.params):
+                    raise LoxRuntimeError(paren, f"Expected {len(method.params)} arguments but got {len(values)}.")
+                if method.is_initializer:
+                    return (method.call_method(interpreter, instance, values),)
+                values.insert(0, instance) # "this"
+                return TailCall(method, values)
+
+            # a field or not an instance at all
+            function = interpreter.get_property(get, instance)
+            return tail_call(function, [argument(env) for argument in arguments])
+        return tail_method_call
+
+    # compiles a list of statements into one closure which runs them in order
+    # and stops at the first statement that completes abruptly (break/return).
+    def compile_block(self, statements):
+        compiled = [self.compile(statement) for statement in statements]
+
+        if not compiled:
+            return lambda env: None
+        if len(compiled) == 1:
+            return compiled[0]
+
+        def block(env):
+            for statement in compiled:
+                completion = statement(env)
+                if completion is not None:
+                    return completion
+            return None
+        return block
+
+    # the resolver already told us where the variable lives, so we pick a
+    # getter for exactly that.
+    def variable_getter(self, expr, name_token):
+        name = name_token.lexeme
+
+        if expr.scope is None:
+            values = self.interpreter.globals_.values
+            slot = expr.slot
+            def get_global(env):
+                value = values[slot]
+                if value is UNDEFINED:
+                    raise LoxRuntimeError(name_token, f"Undefined variable '{name}'.")
+                return value
+            return get_global
+
+        slot = expr.slot
+        if expr.scope == LOCAL:
+            return lambda env: env.values[slot]
+        if expr.scope == CELL:
+            return lambda env: env.values[slot].value
+        return lambda env: env.upvalues[slot].value
+
+    def compile_function(self, declaration):
+        self.scope_depth += 1
+        body = self.compile_block(declaration.body)
+        self.scope_depth -= 1
+        return body
+
+    # returns fn(env, value) which declares a function or class name.
+    def definer(self, name_token):
+        name = name_token.lexeme
+        if self.scope_depth == 0:
+            values = self.interpreter.globals_.values
+            slot = self.interpreter.globals_.intern(name)
+            def define_global(env, value):
+                values[slot] = value
+            return define_global
+
+        def define_local(env, value):
+            env.values.append(value)
+        return define_local
+
+
+# drop-in replacement for the tree-walking Interpreter. it reuses globals and
+# runtime helpers of the Interpreter, but compiles the
+# program to closures before running it.
+class ClosureInterpreter(Interpreter):
+    def interpret(self, syntax):
+        compiler = ClosureCompiler(self)
+        try:
+            if isinstance(syntax, list):
+                program = [compiler.compile(statement) for statement in syntax]
+                for statement in program:
+                    statement(self.globals_)
+            else:
+                # REPL expression
+                value = compiler.compile(syntax)(self.globals_)
+                return self.stringify(value)
+
+        except LoxRuntimeError as error:
+            self.runtime_error(error)
+            return None
+        finally:
+            self.output.flush()
@@ -1,40 +1,89 @@
 from lox_token import Token
 from lox_runtime_error import LoxRuntimeError
 
+# where a resolved local variable lives, see Resolver.resolve_local. globals
+# have no scope (None).
+LOCAL = 0    # environment.values[slot]
+CELL = 1     # environment.values[slot].value, a local some closure captured
+UPVALUE = 2  # environment.upvalues[slot].value, captured from outside
+
+# local variables of one function call (or of a block at the top level).
+# variables live in a list and are addressed by the slot the resolver gave
+# them, so reading a local is one index operation and no string hashing.
+# slots are handed out in declaration order, which is also the order
+# declarations execute in, so defining a variable is just an append.
+#
+# there is no link to the enclosing environment: a function only keeps the
+# variables it actually uses from outside (its upvalues), not every scope
+# around it.
 class Environment:
-    def __init__(self, enclosing: 'Environment' = None):
-        self.values = {}
-        self.enclosing = enclosing
-
-    def get(self, name: Token):
-        if name.lexeme in self.values:
-            return self.values[name.lexeme]
-        if self.enclosing is not None:
-            return self.enclosing.get(name)
-        
-        raise LoxRuntimeError(name, f"Undefined variable '{name.lexeme}'.")
-    
-    def get_at(self, distance, name):
-        return self.ancestor(distance).values[name]
-    
-    def ancestor(self, distnace):
-        environment = self
-        for _ in range(distnace):
-            environment = environment.enclosing
-        return environment
+    __slots__ = ("values", "upvalues")
+
+    def __init__(self, values, upvalues=()):
+        self.values = values
+        self.upvalues = upvalues
 
+    # `name` is not needed for locals, it's here so locals and globals can
+    # be defined the same way.
     def define(self, name, value):
-        self.values[name] = value
-
-    def assign(self, name, value):
-        if name.lexeme in self.values:
-            self.values[name.lexeme] = value
-            return 
-        if self.enclosing is not None:
-            self.enclosing.assign(name, value)
-            return
-        
-        raise LoxRuntimeError(name, f"Undefined variable '{name.lexeme}'.")
-
-    def assign_at(self, distance, name, value):
-        self.ancestor(distance).values[name.lexeme] = value
+        self.values.append(value)
+
+
+# box for a local variable a closure captured. the declaring scope and every
+# closure share the cell, so assignments are seen by all of them, and the
+# closure keeps nothing else of the scope alive.
+class Cell:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+# the upvalues of a new closure, taken from the environment it is created
+# in. `upvalues` are the (is_local, index) pairs the resolver put on the
+# declaration: a cell in the environment's values or one of its upvalues.
+def capture(environment, upvalues):
+    return [environment.values[index] if is_local else environment.upvalues[index]
+            for is_local, index in upvalues]
+
+# puts the parameters some closure captured into cells, at the start of a call.
+def box(values, cells):
+    for slot in cells:
+        values[slot] = Cell(values[slot])
+
+
+# marks a global slot whose name is known but which was never defined (yet).
+UNDEFINED = object()
+
+# global scope. every global name gets interned to a slot the first time the
+# resolver sees it (used or declared), and Variable/Assign nodes keep that slot.
+# globals can be used before they are declared and redefined in the REPL, so a
+# slot only starts out as UNDEFINED and gets its value when the declaration runs.
+class GlobalEnvironment:
+    __slots__ = ("names", "values")
+
+    def __init__(self):
+        self.names = {} # name -> slot
+        self.values = []
+
+    def intern(self, name):
+        slot = self.names.get(name)
+        if slot is None:
+            slot = len(self.values)
+            self.names[name] = slot
+            self.values.append(UNDEFINED)
+        return slot
+
+    def get(self, name: Token, slot):
+        value = self.values[slot]
+        if value is UNDEFINED:
+            raise LoxRuntimeError(name, f"Undefined variable '{name.lexeme}'.")
+        return value
+
+    def define(self, name, value):
+        self.values[self.intern(name)] = value
+
+    def assign(self, name: Token, slot, value):
+        if self.values[slot] is UNDEFINED:
+            raise LoxRuntimeError(name, f"Undefined variable '{name.lexeme}'.")
+        self.values[slot] = value
@@ -1,13 +1,18 @@
 import time
+import operator
+from functools import lru_cache
+from math import copysign
 from Expr import *
 from stmt import *
 from token_type import TokenType
 from lox_runtime_error import LoxRuntimeError
-from return_error import ReturnError
 from error_handler import Lox
-from environment import Environment
-from lox_function import LoxFunction, LoxCallable
+from environment import Environment, GlobalEnvironment, Cell, LOCAL, CELL, capture, box
+from lox_function import LoxFunction, LoxCallable, TailCall
 from lox_class import LoxClass, LoxInstance
+from loop_optimizer import UNSET
+from output import BufferedOutput
+from lox_rope import STRING_TYPES, concatenate
 
 
 # native function 
@@ -22,19 +27,93 @@ class Clock(LoxCallable):
         return "<native fn>"
 
 
-class BreakError(RuntimeError):
-    pass
+# statements return a completion value instead of raising for `break` and
+# `return`: None when they finish normally, BREAK for `break` and a 1-tuple
+# holding the value for `return` (so that returning nil is still "not None").
+# blocks and ifs hand a completion up until it reaches the loop or the
+# function call it belongs to.
+BREAK = object()
+
+# specialized versions of the binary operators by (operand type, operator),
+# only valid when both operands have that type. division is left out on
+# purpose, it keeps its zero check on the generic path. so is `+` on strings,
+# its result may have to be a LoxRope (see lox_rope.py).
+SPECIALIZED = {
+    (float, TokenType.PLUS): operator.add,
+    (float, TokenType.MINUS): operator.sub,
+    (float, TokenType.STAR): operator.mul,
+    (float, TokenType.GREATER): operator.gt,
+    (float, TokenType.GREATER_EQUAL): operator.ge,
+    (float, TokenType.LESS): operator.lt,
+    (float, TokenType.LESS_EQUAL): operator.le,
+    (float, TokenType.EQUAL_EQUAL): operator.eq,
+    (float, TokenType.BANG_EQUAL): operator.ne,
+    # strings compare by length
+    (str, TokenType.GREATER): lambda a, b: len(a) > len(b),
+    (str, TokenType.GREATER_EQUAL): lambda a, b: len(a) >= len(b),
+    (str, TokenType.LESS): lambda a, b: len(a) < len(b),
+    (str, TokenType.LESS_EQUAL): lambda a, b: len(a) <= len(b),
+    (str, TokenType.EQUAL_EQUAL): operator.eq,
+    (str, TokenType.BANG_EQUAL): operator.ne,
+}
+
+# type feedback for one Binary node, set up by the resolver. the first time
+# both operands have the same type and there is a SPECIALIZED operation for
+# it, the node switches to that operation, guarded by a type check on both
+# operands. when the guard fails later the node deoptimizes: it goes back to
+# binary_operation for good instead of flip-flopping between types.
+class BinaryCache:
+    __slots__ = ("type", "operation", "generic")
 
-class Interpreter(VisitorExpr, VisitorStmt):
     def __init__(self):
+        self.type = None # operand type the node is specialized for
+        self.operation = None
+        self.generic = False
+
+    # called whenever the guard doesn't hold.
+    def miss(self, interpreter, operator_token, left, right):
+        if self.operation is not None:
+            self.type = None
+            self.operation = None
+            self.generic = True
+        elif not self.generic and type(left) is type(right):
+            self.operation = SPECIALIZED.get((type(left), operator_token.token_type))
+            if self.operation is not None:
+                self.type = type(left)
+
+        return interpreter.binary_operation(operator_token, left, right)
+
+
+# how many number -> text conversions stringify remembers. loops tend to
+# print or concatenate the same few numbers (counters, indexes) over and over.
+NUMBER_CACHE_SIZE = 256
+
+# text of a number that isn't 0. integral numbers go through int, which gives
+# the text without the ".0" str() would add. from 1e16 on str() switches to
+# exponents ("1e+16"), those (and fractions) are left to str().
+@lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def format_number(value):
+    if value.is_integer() and -1e16 < value < 1e16:
+        return str(int(value))
+    return str(value)
+
+def stringify_number(value):
+    # 0.0 and -0.0 are equal, they would share one cache entry
+    if value == 0:
+        return "-0" if copysign(1.0, value) < 0 else "0"
+    return format_number(value)
+
+
+class Interpreter(VisitorExpr, VisitorStmt):
+    # `output` is where `print` writes to, see output.py
+    def __init__(self, output=None):
+        self.output = output if output is not None else BufferedOutput()
         # permanent global scope
-        self.globals_ = Environment()
+        self.globals_ = GlobalEnvironment()
         # the active environment that tracks our current scope
         self.environment = self.globals_
         # defining native functions
         self.globals_.define("clock", Clock())
-        # stores expr(variable) and the number which indicates where this variable was declared 
-        self.locals_ = {} # _ cause locals keyword exists in python alr.
 
     # API to use by other programs.
     def interpret(self, syntax):
@@ -49,8 +128,15 @@ class Interpreter(VisitorExpr, VisitorStmt):
                 return self.stringify(value)
                 
         except LoxRuntimeError as error:
-            Lox.runtime_error(error)
+            self.runtime_error(error)
             return None
+        finally:
+            self.output.flush()
+
+    # reports the error after everything printed so far.
+    def runtime_error(self, error):
+        self.output.flush()
+        Lox.runtime_error(error)
         
     ################################
     ### visit methods / evaluating 
@@ -96,55 +182,48 @@ class Interpreter(VisitorExpr, VisitorStmt):
         left = self.evaluate(expr.left)
         right = self.evaluate(expr.right)
 
-        match expr.operator.token_type:
-            case TokenType.GREATER:
-                # comapares string by their length
-                if isinstance(left, str) and isinstance(right, str):
-                    return len(left) > len(right)
-                self.check_number_operands(expr.operator, left, right)
-                return float(left) > float(right)
-            case TokenType.GREATER_EQUAL:
-                if isinstance(left, str) and isinstance(right, str):
-                    return len(left) >= len(right)
-                self.check_number_operands(expr.operator, left, right)
-                return float(left) >= float(right)
-            case TokenType.LESS:
-                if isinstance(left, str) and isinstance(right, str):
-                    return len(left) < len(right)
-                self.check_number_operands(expr.operator, left, right)
-                return float(left) < float(right)
-            case TokenType.LESS_EQUAL:
-                if isinstance(left, str) and isinstance(right, str):
-                    return len(left) <= len(right)
-                self.check_number_operands(expr.operator, left, right)
-                return float(left) <= float(right)
-            
-            case TokenType.BANG_EQUAL:
-                return not self.is_equal(left, right)
-            case TokenType.EQUAL_EQUAL:
-                return self.is_equal(left, right)
-            
-            case TokenType.MINUS:
-                self.check_number_operands(expr.operator, left, right)
-                return float(left) - float(right)
-            case TokenType.PLUS:
-                if isinstance(left, float) and isinstance(right, float):
-                    return left + right
-                if isinstance(left, str) or isinstance(right, str):
-                    return self.stringify(left) + self.stringify(right)
-                raise LoxRuntimeError(expr.operator, "Operands must be numbers or strings.")
-            case TokenType.SLASH:
-                self.check_number_operands(expr.operator, left, right)
-                # case: when we try to divide by 0.
-                if right == 0:
-                    raise LoxRuntimeError(expr.operator, "Learn your math dawg! you can't be dividing a number by 0.")
-                return float(left) / float(right)
-            case TokenType.STAR:
-                self.check_number_operands(expr.operator, left, right)
-                return float(left) * float(right)
+        cache = expr.cache
+        if type(left) is cache.type and type(right) is cache.type:
+            return cache.operation(left, right)
+        return cache.miss(self, expr.operator, left, right)
 
     def visit_call_expr(self, expr):
-        callee = self.evaluate(expr.callee)
+        if isinstance(expr.callee, Get):
+            # `obj.method(args)`, we call the method straight away instead of
+            # creating a bound method first and then calling that.
+            get = expr.callee
+            obj = self.evaluate(get.object)
+
+            method = None
+            if isinstance(obj, LoxInstance):
+                method = get.cache.method_of(obj, get.name)
+
+            if method is not None:
+                arguments = [self.evaluate(argument) for argument in expr.arguments]
+                if len(arguments) != method.arity():
+                    raise LoxRuntimeError(expr.paren, f"Expected {method.arity()} arguments but got {len(arguments)}.")
+                return method.call_method(self, obj, arguments)
+
+            # a field or not an instance at all, take the normal path
+            callee = self.get_property(get, obj)
+        else:
+            callee = self.evaluate(expr.callee)
+
+            if type(callee) is LoxFunction and callee.this is None:
+                # plain function call, done right here: the evaluated arguments
+                # become the slots of the call environment as they are.
+                values = [self.evaluate(argument) for argument in expr.arguments]
+                declaration = callee.declaration
+                if len(values) != len(declaration.params):
+                    raise LoxRuntimeError(expr.paren, f"Expected {len(declaration.params)} arguments but got {len(values)}.")
+                if declaration.cells:
+                    box(values, declaration.cells)
+                completion = self.execute_block(declaration.body, Environment(values, callee.upvalues))
+                if completion is None:
+                    return None
+                if type(completion) is tuple:
+                    return completion[0]
+                return self.run_tail_calls(completion)
 
         arguments = []
         for argument in expr.arguments:
@@ -164,19 +243,55 @@ class Interpreter(VisitorExpr, VisitorStmt):
     
     def visit_assign_expr(self, expr):
         value = self.evaluate(expr.value)
+        self.assign_variable(expr.name, expr, value)
+        return value
+    
+    # `i = i + <number>` fused by the Optimizer, one environment access for
+    # reading and writing the variable.
+    def visit_increment_expr(self, expr):
+        value = self.lookup_variable(expr.name, expr)
 
-        distance = self.locals_.get(id(expr))
-        if distance is not None:
-            self.environment.assign_at(distance, expr.name, value)
+        if type(value) is float:
+            value += expr.step
         else:
-            self.globals_.assign(expr.name, value)
+            value = self.binary_operation(expr.operator, value, expr.amount)
+
+        if expr.scope == LOCAL:
+            self.environment.values[expr.slot] = value
+        else:
+            self.assign_variable(expr.name, expr, value)
         return value
-    
+
+    # `i < <number>` (or >, <=, >=) fused by the Optimizer.
+    def visit_compare_expr(self, expr):
+        value = self.lookup_variable(expr.name, expr)
+
+        if type(value) is float:
+            token_type = expr.operator.token_type
+            if token_type is TokenType.LESS:
+                return value < expr.constant
+            if token_type is TokenType.LESS_EQUAL:
+                return value <= expr.constant
+            if token_type is TokenType.GREATER:
+                return value > expr.constant
+            return value >= expr.constant
+
+        return self.binary_operation(expr.operator, value, expr.constant)
+
+    # loop invariant expression, see LoopOptimizer. computed the first time
+    # and read from its hidden variable after that.
+    def visit_memo_expr(self, expr):
+        # hidden variables are always locals of the function the loop is in
+        values = self.environment.values
+        value = values[expr.slot]
+        if value is UNSET:
+            value = self.evaluate(expr.expression)
+            values[expr.slot] = value
+        return value
+
     def visit_get_expr(self, expr):
         obj = self.evaluate(expr.object)
-        if isinstance(obj, LoxInstance):
-            return obj.get(expr.name)
-        raise LoxRuntimeError(expr.name, "Only instances have properties.")
+        return self.get_property(expr, obj)
     
     def visit_set_expr(self, expr):
         obj = self.evaluate(expr.object)
@@ -185,15 +300,13 @@ class Interpreter(VisitorExpr, VisitorStmt):
             raise LoxRuntimeError(expr.name, "Only instances have fields.")
         
         value = self.evaluate(expr.value)
-        obj.set(expr.name, value)
+        expr.cache.set(obj, expr.name, value)
 
         return value
     
     def visit_super_expr(self, expr):
-        distance = self.locals_.get(id(expr))
-
-        superclass = self.environment.get_at(distance, "super")
-        obj = self.environment.get_at(distance - 1, "this")
+        superclass = self.environment.upvalues[expr.upvalue].value
+        obj = self.evaluate(expr.this)
         method = superclass.find_method(expr.method.lexeme)
 
         if method is None:
@@ -214,49 +327,74 @@ class Interpreter(VisitorExpr, VisitorStmt):
     
     def visit_if_stmt(self, stmt):
         if self.is_truthy(self.evaluate(stmt.condition)):
-            self.execute(stmt.then_branch)
+            return self.execute(stmt.then_branch)
         elif stmt.else_branch is not None:
-            self.execute(stmt.else_branch)
+            return self.execute(stmt.else_branch)
         
         return None
     
     def visit_break_stmt(self, stmt):
-        raise BreakError()
+        return BREAK
     
     def visit_print_stmt(self, stmt) -> None:
         value = self.evaluate(stmt.expression)
-        print(self.stringify(value))
+        self.output.write_line(self.stringify(value))
 
     def visit_var_stmt(self, stmt):
         value = None
         if stmt.initializer is not None:
             value = self.evaluate(stmt.initializer)
+        if stmt.cell:
+            value = Cell(value)
         self.environment.define(stmt.name.lexeme, value)
         return None
     
     def visit_while_stmt(self, stmt):
-        try:
-            while(self.is_truthy(self.evaluate(stmt.condition))):
-                self.execute(stmt.body)
-        except BreakError:
-            pass
+        while(self.is_truthy(self.evaluate(stmt.condition))):
+            completion = self.execute(stmt.body)
+            if completion is not None:
+                if completion is BREAK:
+                    return None
+                # `return` from inside the loop
+                return completion
         return None
     
     def visit_block_stmt(self, stmt):
-        self.execute_block(stmt.statements, Environment(self.environment))
-        return None
+        if not stmt.inline:
+            return self.execute_block(stmt.statements, Environment([]))
+
+        # no Environment of its own (see Resolver.visit_block_stmt), its
+        # variables go after the ones already in the current environment.
+        completion = None
+        for statement in stmt.statements:
+            completion = statement.accept(self)
+            if completion is not None:
+                break
+        if stmt.start is not None:
+            del self.environment.values[stmt.start:]
+        return completion
     
     def visit_function_stmt(self, stmt):
-        func = LoxFunction(stmt, self.environment, False)
+        if stmt.cell:
+            # the cell has to exist before the function can capture it
+            cell = Cell(None)
+            self.environment.define(stmt.name.lexeme, cell)
+            cell.value = LoxFunction(stmt, capture(self.environment, stmt.upvalues), False)
+            return None
+
+        func = LoxFunction(stmt, capture(self.environment, stmt.upvalues), False)
         self.environment.define(stmt.name.lexeme, func)
         return None
     
     def visit_return_stmt(self, stmt):
+        if stmt.tail_call:
+            return self.tail_call(stmt.value)
+
         value = None
         if stmt.value is not None:
             value = self.evaluate(stmt.value)
 
-        raise ReturnError(value)
+        return (value,)
     
     def visit_class_stmt(self, stmt):
         superclass = None
@@ -266,24 +404,31 @@ class Interpreter(VisitorExpr, VisitorStmt):
                 raise LoxRuntimeError(stmt.superclass.name, 
                                       "Superclass must be a name.")
 
-        self.environment.define(stmt.name.lexeme, None)
+        cell = None
+        if stmt.cell:
+            # the methods capture the class, so its cell comes first
+            cell = Cell(None)
+            self.environment.define(stmt.name.lexeme, cell)
 
+        environment = self.environment
         if stmt.superclass is not None:
-            self.environment = Environment(self.environment)
-            self.environment.define("super", superclass)
+            environment = Environment([Cell(superclass)],
+                                      capture(self.environment, stmt.upvalues))
         
         methods = {}
         for method in stmt.methods:
-            func = LoxFunction(method, self.environment,
+            func = LoxFunction(method, capture(environment, method.upvalues),
                                method.name.lexeme == "init")
             methods[method.name.lexeme] = func
 
-        klass = LoxClass(stmt.name.lexeme, superclass, methods)
-
-        if stmt.superclass is not None:
-            self.environment = self.environment.enclosing
+        klass = self.new_class(stmt, superclass, methods)
 
-        self.environment.assign(stmt.name, klass)
+        # methods only look the class up once they are called, so the class can
+        # be defined right away instead of defining nil first and assigning later.
+        if cell is not None:
+            cell.value = klass
+        else:
+            self.environment.define(stmt.name.lexeme, klass)
 
         return None
     
@@ -291,6 +436,10 @@ class Interpreter(VisitorExpr, VisitorStmt):
     ## helper functions
     ####################
 
+    # the class object of a class declaration, the profiler makes its own
+    def new_class(self, stmt, superclass, methods):
+        return LoxClass(stmt.name.lexeme, superclass, methods)
+
     # this is a helper method which simply sends the expression back into the
     # interpreter’s visitor implementation:
     def evaluate(self, expr):
@@ -317,40 +466,184 @@ class Interpreter(VisitorExpr, VisitorStmt):
         raise LoxRuntimeError(operator, "Operands must be numbers.")
     
     def stringify(self, value):
+        # numbers and strings first, they are what gets printed and concatenated
+        if type(value) is float:
+            return stringify_number(value)
+
+        if type(value) is str:
+            return value
+
         if value is None:
             return "nil"
         
         if isinstance(value, bool):
             return str(value).lower()
         
-        if isinstance(value, float):
-            text = str(value)
-            if text.endswith(".0"):
-                text = text[:-2]
-            return text
-        
         return str(value)
     
+    # applies a binary operator to already evaluated operands. shared with the
+    # other execution engines so every engine reports the same runtime errors.
+    def binary_operation(self, operator, left, right):
+        # `+` doesn't go through the match, building report lines out of
+        # strings and numbers is common and the match checks `+` late.
+        if operator.token_type is TokenType.PLUS:
+            return self.add(operator, left, right)
+
+        match operator.token_type:
+            case TokenType.GREATER:
+                # comapares string by their length
+                if isinstance(left, STRING_TYPES) and isinstance(right, STRING_TYPES):
+                    return len(left) > len(right)
+                self.check_number_operands(operator, left, right)
+                return float(left) > float(right)
+            case TokenType.GREATER_EQUAL:
+                if isinstance(left, STRING_TYPES) and isinstance(right, STRING_TYPES):
+                    return len(left) >= len(right)
+                self.check_number_operands(operator, left, right)
+                return float(left) >= float(right)
+            case TokenType.LESS:
+                if isinstance(left, STRING_TYPES) and isinstance(right, STRING_TYPES):
+                    return len(left) < len(right)
+                self.check_number_operands(operator, left, right)
+                return float(left) < float(right)
+            case TokenType.LESS_EQUAL:
+                if isinstance(left, STRING_TYPES) and isinstance(right, STRING_TYPES):
+                    return len(left) <= len(right)
+                self.check_number_operands(operator, left, right)
+                return float(left) <= float(right)
+            
+            case TokenType.BANG_EQUAL:
+                return not self.is_equal(left, right)
+            case TokenType.EQUAL_EQUAL:
+                return self.is_equal(left, right)
+            
+            case TokenType.MINUS:
+                self.check_number_operands(operator, left, right)
+                return float(left) - float(right)
+            case TokenType.SLASH:
+                self.check_number_operands(operator, left, right)
+                # case: when we try to divide by 0.
+                if right == 0:
+                    raise LoxRuntimeError(operator, "Learn your math dawg! you can't be dividing a number by 0.")
+                return float(left) / float(right)
+            case TokenType.STAR:
+                self.check_number_operands(operator, left, right)
+                return float(left) * float(right)
+
+    # `+`, for numbers and for strings (with a number or string on the other side).
+    def add(self, operator, left, right):
+        if isinstance(left, float) and isinstance(right, float):
+            return left + right
+        if isinstance(left, STRING_TYPES):
+            if not isinstance(right, STRING_TYPES):
+                right = self.stringify(right)
+            return concatenate(left, right)
+        if isinstance(right, STRING_TYPES):
+            return concatenate(self.stringify(left), right)
+        raise LoxRuntimeError(operator, "Operands must be numbers or strings.")
+
+    # `return callee(args)` in tail position. lox functions are not called
+    # here but returned as a TailCall completion, everything else (natives,
+    # classes, initializers) is called as usual and returned as a value.
+    def tail_call(self, expr):
+        if isinstance(expr.callee, Get):
+            get = expr.callee
+            obj = self.evaluate(get.object)
+
+            method = None
+            if isinstance(obj, LoxInstance):
+                method = get.cache.method_of(obj, get.name)
+
+            if method is not None:
+                values = [self.evaluate(argument) for argument in expr.arguments]
+                if len(values) != method.arity():
+                    raise LoxRuntimeError(expr.paren, f"Expected {method.arity()} arguments but got {len(values)}.")
+                if method.is_initializer:
+                    return (method.call_method(self, obj, values),)
+                values.insert(0, obj) # "this"
+                return TailCall(method, values)
+
+            callee = self.get_property(get, obj)
+        else:
+            callee = self.evaluate(expr.callee)
+
+        values = [self.evaluate(argument) for argument in expr.arguments]
+
+        if type(callee) is LoxFunction and callee.this is None:
+            params = callee.declaration.params
+            if len(values) != len(params):
+                raise LoxRuntimeError(expr.paren, f"Expected {len(params)} arguments but got {len(values)}.")
+            return TailCall(callee, values)
+
+        if not isinstance(callee, LoxCallable):
+            raise LoxRuntimeError(expr.paren, "Can only call functions and classes.")
+        if len(values) != callee.arity():
+            raise LoxRuntimeError(expr.paren, f"Expected {callee.arity()} arguments but got {len(values)}.")
+        return (callee.call(self, values),)
+
+    # the trampoline: runs tail calls until one of them really returns, all
+    # in this one python frame no matter how long the chain of calls is.
+    def run_tail_calls(self, tail_call):
+        while True:
+            function = tail_call.function
+            declaration = function.declaration
+            if declaration.cells:
+                box(tail_call.values, declaration.cells)
+            completion = self.execute_block(declaration.body,
+                                            Environment(tail_call.values, function.upvalues))
+            if completion is None:
+                return None
+            if type(completion) is tuple:
+                return completion[0]
+            tail_call = completion
+
     def execute(self, stmt: Stmt):
-        stmt.accept(self)
+        return stmt.accept(self)
 
+    # runs the statements until one of them completes abruptly and returns
+    # that completion (None if they all ran to the end).
     def execute_block(self, statements, environment):
         previous = self.environment
         try:
             self.environment = environment
 
             for statement in statements:
-                self.execute(statement)
+                completion = statement.accept(self)
+                if completion is not None:
+                    return completion
+            return None
             
         finally:
             self.environment = previous
         
-    def resolve(self, expr, depth):
-        self.locals_[id(expr)] = depth
+    def get_property(self, expr, obj):
+        if isinstance(obj, LoxInstance):
+            # fields shadow methods, the cache knows which one this is
+            cache = expr.cache
+            if cache.shape is obj.shape and cache.index is not None:
+                return obj.values[cache.index]
+            return cache.get(obj, expr.name)
+        raise LoxRuntimeError(expr.name, "Only instances have properties.")
 
     def lookup_variable(self, name, expr):
-        distance = self.locals_.get(id(expr)) # didn't know that dict has .get syntax too TT
-        if distance is not None:
-            return self.environment.get_at(distance, name.lexeme)
+        # scope and slot were stored on the node by the resolver, globals
+        # have no scope and their slot points into the global table.
+        scope = expr.scope
+        if scope == LOCAL:
+            return self.environment.values[expr.slot]
+        if scope is None:
+            return self.globals_.get(name, expr.slot)
+        if scope == CELL:
+            return self.environment.values[expr.slot].value
+        return self.environment.upvalues[expr.slot].value
+
+    def assign_variable(self, name, expr, value):
+        scope = expr.scope
+        if scope == LOCAL:
+            self.environment.values[expr.slot] = value
+        elif scope is None:
+            self.globals_.assign(name, expr.slot, value)
+        elif scope == CELL:
+            self.environment.values[expr.slot].value = value
         else:
-            return self.globals_.get(name)
+            self.environment.upvalues[expr.slot].value = value
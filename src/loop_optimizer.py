@@ -0,0 +1,406 @@
+from Expr import *
+from stmt import *
+from token_type import TokenType
+from lox_token import Token
+
+# loop invariant code motion, `--opt-level=2`. runs after the Optimizer and
+# before the Resolver.
+#
+# an expression inside a loop that only does arithmetic (or comparisons,
+# `!`, `and`/`or`) on literals and on variables the loop never changes gives
+# the same value on every iteration, so we only compute it once. every such
+# expression gets wrapped in a Memo node backed by a hidden variable that is
+# declared right before the loop:
+#
+#     while (i < n) { sum = sum + a * b; }
+#
+# becomes
+#
+#     { var $memo0 = <unset>; while (i < n) { sum = sum + memo($memo0, a * b); } }
+#
+# a Memo evaluates its expression the first time it runs and returns the
+# stored value after that. since that first evaluation happens exactly where
+# the expression used to be evaluated, runtime errors (`a * b` on a string)
+# still happen at the same point and line, and a loop that never runs never
+# evaluates it. identical expressions in one loop share the hidden variable
+# (common subexpression elimination). expressions with calls, property
+# access or assignments are never touched.
+
+# value of a hidden variable before its Memo ran. it ends up in the syntax
+# tree, so it pickles as a reference to this module's UNSET (see ast_cache.py)
+# and stays the same object when a cached tree is loaded.
+class Unset:
+    def __reduce__(self):
+        return "UNSET"
+
+    def __repr__(self):
+        return "<unset>"
+
+UNSET = Unset()
+
+
+# what a piece of code can change: the variables it assigns or declares
+# and whether it calls anything (calls can run code we can't see from here).
+# assignments are tracked by name, which is conservative when names shadow.
+class Effects(VisitorExpr, VisitorStmt):
+    def __init__(self):
+        self.assigned = set()
+        # names assigned somewhere inside a function body
+        self.assigned_in_functions = set()
+        self.calls = False
+        self.function_depth = 0
+
+    def scan(self, syntax):
+        if isinstance(syntax, list):
+            for node in syntax:
+                node.accept(self)
+        elif syntax is not None:
+            syntax.accept(self)
+        return self
+
+    def assign(self, name):
+        self.assigned.add(name.lexeme)
+        if self.function_depth > 0:
+            self.assigned_in_functions.add(name.lexeme)
+
+    ##############
+    ## expressions
+    ##############
+
+    def visit_assign_expr(self, expr):
+        self.assign(expr.name)
+        self.scan(expr.value)
+
+    def visit_increment_expr(self, expr):
+        self.assign(expr.name)
+
+    def visit_memo_expr(self, expr):
+        self.assign(expr.name)
+        self.scan(expr.expression)
+
+    def visit_call_expr(self, expr):
+        self.calls = True
+        self.scan(expr.callee)
+        self.scan(expr.arguments)
+
+    def visit_binary_expr(self, expr):
+        self.scan(expr.left)
+        self.scan(expr.right)
+
+    def visit_logical_expr(self, expr):
+        self.scan(expr.left)
+        self.scan(expr.right)
+
+    def visit_unary_expr(self, expr):
+        self.scan(expr.right)
+
+    def visit_grouping_expr(self, expr):
+        self.scan(expr.expression)
+
+    def visit_get_expr(self, expr):
+        self.scan(expr.object)
+
+    def visit_set_expr(self, expr):
+        self.scan(expr.object)
+        self.scan(expr.value)
+
+    def visit_literal_expr(self, expr):
+        pass
+
+    def visit_variable_expr(self, expr):
+        pass
+
+    def visit_compare_expr(self, expr):
+        pass
+
+    def visit_super_expr(self, expr):
+        pass
+
+    def visit_this_expr(self, expr):
+        pass
+
+    #############
+    ## statement
+    #############
+
+    def visit_expression_stmt(self, stmt):
+        self.scan(stmt.expression)
+
+    def visit_print_stmt(self, stmt):
+        self.scan(stmt.expression)
+
+    def visit_var_stmt(self, stmt):
+        self.assigned.add(stmt.name.lexeme)
+        self.scan(stmt.initializer)
+
+    def visit_block_stmt(self, stmt):
+        self.scan(stmt.statements)
+
+    def visit_if_stmt(self, stmt):
+        self.scan(stmt.condition)
+        self.scan(stmt.then_branch)
+        self.scan(stmt.else_branch)
+
+    def visit_while_stmt(self, stmt):
+        self.scan(stmt.condition)
+        self.scan(stmt.body)
+
+    def visit_break_stmt(self, stmt):
+        pass
+
+    def visit_return_stmt(self, stmt):
+        self.scan(stmt.value)
+
+    def visit_function_stmt(self, stmt):
+        self.assigned.add(stmt.name.lexeme)
+        for param in stmt.params:
+            self.assigned.add(param.lexeme)
+        self.function_depth += 1
+        self.scan(stmt.body)
+        self.function_depth -= 1
+
+    def visit_class_stmt(self, stmt):
+        self.assigned.add(stmt.name.lexeme)
+        self.scan(stmt.superclass)
+        self.scan(stmt.methods)
+
+
+def reads_variable(expr):
+    if isinstance(expr, (Variable, Compare)):
+        return True
+    if isinstance(expr, Unary):
+        return reads_variable(expr.right)
+    if isinstance(expr, (Binary, Logical)):
+        return reads_variable(expr.left) or reads_variable(expr.right)
+    return False
+
+
+# a loop we are hoisting expressions out of.
+class Loop:
+    def __init__(self, effects, local_names, assigned_in_functions, memo_names):
+        self.effects = effects
+        # names of local variables visible right before the loop
+        self.local_names = local_names
+        self.assigned_in_functions = assigned_in_functions
+        self.memo_names = memo_names # shared with the LoopOptimizer, for unique names
+
+        # structural key of an expression -> hidden variable token
+        self.memos = {}
+
+    def is_invariant_variable(self, name):
+        if name in self.effects.assigned:
+            return False
+        if not self.effects.calls:
+            return True
+        # a call can change globals and any variable some function assigns
+        # to. a local variable that no function ever assigns can only change
+        # in the code of its own scope, and that's not running during the loop.
+        return name in self.local_names and name not in self.assigned_in_functions
+
+    # the key of `expr` if it's pure and invariant in this loop, None otherwise.
+    def invariant_key(self, expr):
+        if isinstance(expr, Literal):
+            # repr, so that 0 and -0 (and 1 and true) don't look the same
+            return ("literal", type(expr.value), repr(expr.value))
+        if isinstance(expr, Variable):
+            if self.is_invariant_variable(expr.name.lexeme):
+                return ("variable", expr.name.lexeme)
+            return None
+        if isinstance(expr, Compare):
+            if self.is_invariant_variable(expr.name.lexeme):
+                return ("compare", expr.name.lexeme, expr.operator.token_type, repr(expr.constant))
+            return None
+        if isinstance(expr, Unary):
+            right = self.invariant_key(expr.right)
+            if right is None:
+                return None
+            return ("unary", expr.operator.token_type, right)
+        if isinstance(expr, (Binary, Logical)):
+            left = self.invariant_key(expr.left)
+            right = self.invariant_key(expr.right)
+            if left is None or right is None:
+                return None
+            return ("binary", expr.operator.token_type, left, right)
+        return None
+
+    def memo(self, key, expr):
+        name = self.memos.get(key)
+        if name is None:
+            # `$` can't appear in lox identifiers, so these never clash
+            name = Token(TokenType.IDENTIFIER, f"$memo{len(self.memo_names)}", None, 0)
+            self.memo_names.append(name)
+            self.memos[key] = name
+        return Memo(expr, name)
+
+
+class LoopOptimizer(VisitorExpr, VisitorStmt):
+    def __init__(self):
+        # names declared in each local scope we are in, the global scope is
+        # not tracked.
+        self.scopes = []
+        # loops we are in, the outermost first
+        self.loops = []
+        self.memo_names = []
+        self.assigned_in_functions = set()
+
+    # API to use by other programs.
+
+    def optimize(self, syntax):
+        if not isinstance(syntax, list):
+            # REPL expression, there are no loops in it
+            return syntax
+
+        self.assigned_in_functions = Effects().scan(syntax).assigned_in_functions
+        return [statement.accept(self) for statement in syntax]
+
+    ##############
+    ## expressions
+    ##############
+
+    def visit_literal_expr(self, expr):
+        return expr
+
+    def visit_variable_expr(self, expr):
+        return expr
+
+    def visit_compare_expr(self, expr):
+        return expr
+
+    def visit_increment_expr(self, expr):
+        return expr
+
+    def visit_super_expr(self, expr):
+        return expr
+
+    def visit_this_expr(self, expr):
+        return expr
+
+    def visit_memo_expr(self, expr):
+        return expr
+
+    def visit_grouping_expr(self, expr):
+        return Grouping(self.hoist(expr.expression))
+
+    def visit_unary_expr(self, expr):
+        return Unary(expr.operator, self.hoist(expr.right))
+
+    def visit_binary_expr(self, expr):
+        return Binary(self.hoist(expr.left), expr.operator, self.hoist(expr.right))
+
+    def visit_logical_expr(self, expr):
+        return Logical(self.hoist(expr.left), expr.operator, self.hoist(expr.right))
+
+    def visit_call_expr(self, expr):
+        return Call(self.hoist(expr.callee), expr.paren,
+                    [self.hoist(argument) for argument in expr.arguments])
+
+    def visit_assign_expr(self, expr):
+        return Assign(expr.name, self.hoist(expr.value))
+
+    def visit_get_expr(self, expr):
+        return Get(self.hoist(expr.object), expr.name)
+
+    def visit_set_expr(self, expr):
+        return Set(self.hoist(expr.object), expr.name, self.hoist(expr.value))
+
+    #############
+    ## statement
+    #############
+
+    def visit_expression_stmt(self, stmt):
+        return Expression(self.hoist(stmt.expression))
+
+    def visit_print_stmt(self, stmt):
+        return Print(self.hoist(stmt.expression))
+
+    def visit_var_stmt(self, stmt):
+        initializer = None
+        if stmt.initializer is not None:
+            initializer = self.hoist(stmt.initializer)
+        self.declare(stmt.name)
+        return Var(stmt.name, initializer)
+
+    def visit_block_stmt(self, stmt):
+        self.scopes.append(set())
+        statements = [statement.accept(self) for statement in stmt.statements]
+        self.scopes.pop()
+        return Block(statements)
+
+    def visit_if_stmt(self, stmt):
+        else_branch = None
+        if stmt.else_branch is not None:
+            else_branch = stmt.else_branch.accept(self)
+        return If(self.hoist(stmt.condition), stmt.then_branch.accept(self), else_branch)
+
+    def visit_while_stmt(self, stmt):
+        local_names = set().union(*self.scopes)
+        loop = Loop(Effects().scan([stmt]), local_names,
+                    self.assigned_in_functions, self.memo_names)
+
+        self.loops.append(loop)
+        condition = self.hoist(stmt.condition)
+        body = stmt.body.accept(self)
+        self.loops.pop()
+
+        loop_stmt = While(condition, body)
+        if not loop.memos:
+            return loop_stmt
+
+        # the hidden variables start out unset every time the loop starts,
+        # the values of the last run may be stale by then.
+        hidden = [Var(name, Literal(UNSET)) for name in loop.memos.values()]
+        return Block(hidden + [loop_stmt])
+
+    def visit_break_stmt(self, stmt):
+        return stmt
+
+    def visit_return_stmt(self, stmt):
+        value = None
+        if stmt.value is not None:
+            value = self.hoist(stmt.value)
+        return Return(stmt.keyword, value)
+
+    def visit_function_stmt(self, stmt):
+        self.declare(stmt.name)
+        return self.function(stmt)
+
+    def visit_class_stmt(self, stmt):
+        self.declare(stmt.name)
+        methods = [self.function(method) for method in stmt.methods]
+        return Class(stmt.name, stmt.superclass, methods)
+
+    ####################
+    ## helper functions
+    ####################
+
+    def hoist(self, expr):
+        # only worth it for expressions that compute something from a
+        # variable, constant ones were folded already.
+        if not self.loops or not isinstance(expr, (Unary, Binary, Logical, Compare)) or not reads_variable(expr):
+            return expr.accept(self)
+
+        for index, loop in enumerate(self.loops):
+            key = loop.invariant_key(expr)
+            if key is not None:
+                # parts of it may still be invariant in a loop further out
+                loops = self.loops
+                self.loops = loops[:index]
+                inner = expr.accept(self)
+                self.loops = loops
+                return loop.memo(key, inner)
+
+        return expr.accept(self)
+
+    def declare(self, name):
+        if self.scopes:
+            self.scopes[-1].add(name.lexeme)
+
+    # a function body is a new world, loops outside of it don't matter there.
+    def function(self, stmt):
+        loops = self.loops
+        self.loops = []
+        self.scopes.append({param.lexeme for param in stmt.params})
+        body = [statement.accept(self) for statement in stmt.body]
+        self.scopes.pop()
+        self.loops = loops
+        return Function(stmt.name, stmt.params, body)
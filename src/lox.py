@@ -4,10 +4,43 @@ from pathlib import Path
 from lox_scanner import Scanner
 from parser import Parser
 from interpreter import Interpreter
+from closure_compiler import ClosureInterpreter
+from vm import VM
 from resolver import Resolver
+from optimizer import Optimizer
+from loop_optimizer import LoopOptimizer
 from error_handler import Lox
+from output import BufferedOutput
+from profiler import ProfilingInterpreter, PROFILE_FORMATS
+import ast_cache
 from Expr import *
 
+# execution engines selectable with `--engine=<name>`, tree-walker is the default.
+ENGINES = {
+    "tree": Interpreter,
+    "closure": ClosureInterpreter,
+    "vm": VM,
+}
+
+# `--opt-level=<n>`, 0 turns the Optimizer pass off. 1 (the default) folds
+# constants, prunes dead branches and fuses common loop patterns. 2 also
+# runs the LoopOptimizer, which computes loop invariant expressions only once.
+OPT_LEVELS = (0, 1, 2)
+opt_level = 1
+
+# `--cache` keeps the resolved syntax trees of scripts on disk, see ast_cache.py
+use_cache = False
+
+# `--line-buffered` writes every printed line right away instead of in big
+# chunks, see output.py. output to a terminal is always line buffered.
+line_buffered = None
+
+# `--profile[=<format>]` runs the program on the tree-walker with a profiler
+# and writes what it found (see profiler.py) to stderr or to the file given
+# with `--profile-file=<path>`.
+profile_format = None
+profile_file = None
+
 # initializing interpretor globally so we can use the same object, when each REPL loop resets.
 interpreter = Interpreter()
 
@@ -19,7 +52,7 @@ def run_file(path):
     try:
         with open(file_path, "r", encoding="utf-8") as file:
             source = file.read()
-        run(source)
+        run(source, file_path)
 
         if Lox.had_error:
             sys.exit(65)
@@ -37,14 +70,21 @@ def run_file(path):
 def run_prompt():
     while True:
         try:
+            # whatever the last line printed has to be out before the prompt
+            interpreter.output.flush()
             line = input("> ")
             Lox.had_error = False
             
             scanner = Scanner(line)
-            tokens = scanner.scan_tokens()
+            tokens = scanner.scan_buffer()
             parser = Parser(tokens)
             syntax = parser.parse_repl()
 
+            if not Lox.had_error:
+                syntax = optimize(syntax)
+                if Lox.had_error:
+                    continue # reported by optimize already
+
             resolver = Resolver(interpreter)
             resolver.resolve(syntax)
 
@@ -64,36 +104,129 @@ def run_prompt():
             print() 
             break
 
-def run(source):
+# `path` is the script the source came from, its syntax tree gets cached.
+def run(source, path=None):
+    cache = None
+    if path is not None and use_cache:
+        cache = ast_cache.cache_path(path, opt_level)
+        statements = ast_cache.load(cache, source, interpreter.globals_)
+        if statements is not None:
+            interpreter.interpret(statements)
+            return
+
+    statements = compile_source(source)
+    if statements is None:
+        return
+
+    if cache is not None:
+        ast_cache.store(cache, source, interpreter.globals_, statements)
+    interpreter.interpret(statements)
+
+# scans, parses, optimizes and resolves the source. None when there are errors.
+def compile_source(source):
     scanner = Scanner(source)
-    tokens = scanner.scan_tokens()
-    # for token in tokens: # this is to see how tokenizer works.
-    #     print(token)
+    tokens = scanner.scan_buffer()
+    # for index in range(len(tokens)): # this is to see how tokenizer works.
+    #     print(tokens.token(index))
     parser = Parser(tokens)
     statements = parser.parse()
 
     if Lox.had_error:
-        return
+        return None
+
+    statements = optimize(statements)
+    if Lox.had_error:
+        return None
     
     resolver = Resolver(interpreter)
     resolver.resolve(statements)
 
     if Lox.had_error:
-        return
-    
-    interpreter.interpret(statements)
+        return None
+    return statements
+
+# the optimized tree, or the tree as it is when it has static errors (they are
+# reported here then).
+def optimize(syntax):
+    if opt_level > 0:
+        syntax = Optimizer(interpreter).optimize(syntax)
+    if opt_level > 1:
+        syntax = LoopOptimizer().optimize(syntax)
+    return syntax
 
 def main():
+    global interpreter, opt_level, use_cache, line_buffered, profile_format, profile_file
     args = sys.argv[1:] # argv[0] is script name so we ignore it
 
-    if len(args) > 1:
-        print(f"Usage: pylox [script]")
-        sys.exit(64)
-    elif len(args) == 1:
-        run_file(args[0])
+    # options start with `--`, everything else is the script path.
+    options = [arg for arg in args if arg.startswith("--")]
+    args = [arg for arg in args if not arg.startswith("--")]
+
+    engine = None
+    for option in options:
+        if option.startswith("--engine="):
+            engine = option[len("--engine="):]
+        elif option.startswith("--opt-level="):
+            level = option[len("--opt-level="):]
+            if not level.isdigit() or int(level) not in OPT_LEVELS:
+                usage()
+            opt_level = int(level)
+        elif option == "--cache":
+            use_cache = True
+        elif option == "--line-buffered":
+            line_buffered = True
+        elif option == "--profile":
+            profile_format = "report"
+        elif option.startswith("--profile="):
+            profile_format = option[len("--profile="):]
+            if profile_format not in PROFILE_FORMATS:
+                usage()
+        elif option.startswith("--profile-file="):
+            profile_file = option[len("--profile-file="):]
+        else:
+            usage()
+
+    output = BufferedOutput(line_buffered=line_buffered)
+    if profile_format is not None or profile_file is not None:
+        # the profiler watches the tree-walker, other engines can't be profiled
+        if engine not in (None, "tree"):
+            usage()
+        interpreter = ProfilingInterpreter(output)
+        profile_format = profile_format or "report"
     else:
-        # REPL
-        run_prompt()
+        engine = engine or "tree"
+        if engine not in ENGINES:
+            usage()
+        interpreter = ENGINES[engine](output)
+
+    if len(args) > 1:
+        usage()
+
+    try:
+        if len(args) == 1:
+            run_file(args[0])
+        else:
+            # REPL
+            run_prompt()
+    finally:
+        # also when run_file exits because of an error
+        if profile_format is not None:
+            write_profile()
+
+def write_profile():
+    text = interpreter.profiler.write(profile_format)
+    if profile_file is None:
+        sys.stderr.write(text)
+        return
+    with open(profile_file, "w", encoding="utf-8") as file:
+        file.write(text)
+
+def usage():
+    levels = '|'.join(str(level) for level in OPT_LEVELS)
+    formats = '|'.join(PROFILE_FORMATS)
+    print(f"Usage: pylox [--engine={'|'.join(ENGINES)}] [--opt-level={levels}] [--cache] [--line-buffered] "
+          f"[--profile[={formats}]] [--profile-file=<path>] [script]")
+    sys.exit(64)
 
 if __name__ == "__main__":
     main()
@@ -6,41 +6,75 @@ class LoxClass(LoxCallable):
         self.name = name
         self.superclass = superclass
         self.methods = methods
+
+        # flattened method table, inherited methods first so our own methods
+        # override them. a class can't change after it's declared, so this is
+        # built once and method lookup never has to walk the superclass chain.
+        self.method_table = {}
+        if superclass is not None:
+            self.method_table.update(superclass.method_table)
+        self.method_table.update(methods)
+
+        self.initializer = self.method_table.get("init")
+
+        # every instance starts out with this (empty) shape. each class has
+        # its own root, so a shape also tells us the class of an instance.
+        self.root_shape = Shape(self, {})
     
     def find_method(self, name):
-        if name in self.methods:
-            return self.methods.get(name)
-        
-        if self.superclass is not None:
-            return self.superclass.find_method(name)
-        return None
+        return self.method_table.get(name)
     
     def call(self, interpreter, arguments):
         instance = LoxInstance(self)
-        initializer = self.find_method("init")
-        if initializer is not None:
-            initializer.bind(instance).call(interpreter, arguments)
+        if self.initializer is not None:
+            self.initializer.call_method(interpreter, instance, arguments)
 
         return instance
     
     def arity(self):
-        initializer = self.find_method("init")
-        if initializer is None:
+        if self.initializer is None:
             return 0
         
-        return initializer.arity()
+        return self.initializer.arity()
     
     def __str__(self):
         return self.name
 
+
+# hidden class of an instance: which fields it has and at which index of
+# LoxInstance.values they live. instances that get the same fields in the same
+# order (which is what `init` does) end up sharing one shape, so the name ->
+# index map is stored once instead of one dict per instance.
+class Shape:
+    __slots__ = ("klass", "names", "transitions")
+
+    def __init__(self, klass, names):
+        self.klass = klass
+        self.names = names # field name -> index, never changes
+        self.transitions = {} # field name -> shape with that field added
+
+    def with_field(self, name):
+        shape = self.transitions.get(name)
+        if shape is None:
+            names = dict(self.names)
+            names[name] = len(names)
+            shape = Shape(self.klass, names)
+            self.transitions[name] = shape
+        return shape
+
+
 class LoxInstance:
+    __slots__ = ("klass", "shape", "values")
+
     def __init__(self, klass):
         self.klass = klass
-        self.fields = {}
+        self.shape = klass.root_shape
+        self.values = [] # field values, in the order of self.shape
 
     def get(self, name):
-        if name.lexeme in self.fields:
-            return self.fields.get(name.lexeme)
+        index = self.shape.names.get(name.lexeme)
+        if index is not None:
+            return self.values[index]
         
         method = self.klass.find_method(name.lexeme)
         if method is not None: 
@@ -51,10 +85,88 @@ class LoxInstance:
         )
     
     def set(self, name, value):
-        self.fields[name.lexeme] = value
+        index = self.shape.names.get(name.lexeme)
+        if index is not None:
+            self.values[index] = value
+        else:
+            # new field, move on to the next shape
+            self.shape = self.shape.with_field(name.lexeme)
+            self.values.append(value)
         # debugging lines, hehe :)
         # print(f"added {name.lexeme} = {value} in a fucking class.")
-        # print(f"printing fields:\n {self.fields}")
+        # print(f"printing fields:\n {self.shape.names}")
 
     def __str__(self):
         return self.klass.name + " instance"
+
+
+# inline cache for a property access site (a Get node), keyed by the shape of
+# the last instance the site saw. the shape tells us whether the property is a
+# field (and its index) and, since shapes belong to a class, which method it
+# is otherwise. shapes and classes never change, so an entry never goes stale.
+class PropertyCache:
+    __slots__ = ("shape", "index", "method")
+
+    def __init__(self):
+        self.shape = None
+        self.index = None
+        self.method = None
+
+    def update(self, instance, name):
+        shape = instance.shape
+        self.shape = shape
+        self.index = shape.names.get(name.lexeme)
+        self.method = None
+        if self.index is None:
+            self.method = shape.klass.find_method(name.lexeme)
+
+    def get(self, instance, name):
+        if self.shape is not instance.shape:
+            self.update(instance, name)
+
+        if self.index is not None:
+            return instance.values[self.index]
+        return self.find_method(name).bind(instance)
+
+    # the method `name` refers to, or None when it is a field.
+    def method_of(self, instance, name):
+        if self.shape is not instance.shape:
+            self.update(instance, name)
+
+        if self.index is not None:
+            return None
+        return self.find_method(name)
+
+    def find_method(self, name):
+        if self.method is None:
+            raise LoxRuntimeError(
+                name, "Undefined property '" + name.lexeme + "'."
+            )
+        return self.method
+
+
+# inline cache for a field assignment site (a Set node). remembers the shape
+# it saw last and either the index of the field or, when the assignment adds
+# a new field, the shape the instance moves on to.
+class SetPropertyCache:
+    __slots__ = ("shape", "index", "next_shape")
+
+    def __init__(self):
+        self.shape = None
+        self.index = None
+        self.next_shape = None
+
+    def set(self, instance, name, value):
+        shape = instance.shape
+        if self.shape is not shape:
+            self.shape = shape
+            self.index = shape.names.get(name.lexeme)
+            self.next_shape = None
+            if self.index is None:
+                self.next_shape = shape.with_field(name.lexeme)
+
+        if self.next_shape is None:
+            instance.values[self.index] = value
+        else:
+            instance.shape = self.next_shape
+            instance.values.append(value)
@@ -1,5 +1,4 @@
-from environment import Environment
-from return_error import ReturnError
+from environment import Environment, box
 from stmt import *
 from Expr import *
 
@@ -11,37 +10,73 @@ class LoxCallable(ABC):
     def call(self, interpreter, arguments: list):
         pass
 
+# completion of a `return f(args)` in tail position (see Resolver). instead of
+# calling f right away, which nests python frames for every lox call, the
+# return statement hands the call back to whoever called the function it is
+# in, and that runs the calls one after another in a loop (a trampoline).
+class TailCall:
+    __slots__ = ("function", "values")
+
+    def __init__(self, function, values):
+        self.function = function
+        self.values = values # the evaluated arguments, "this" first for methods
+
+
 class LoxFunction(LoxCallable):
-    def __init__(self, declaration, closure, is_initializer):
+    def __init__(self, declaration, upvalues, is_initializer, this=None):
         self.is_initializer = is_initializer
         self.declaration = declaration
-        self.closure = closure
+        # cells of the variables from outside the function it uses, see
+        # environment.capture
+        self.upvalues = upvalues
+        # the instance of a bound method
+        self.this = this
 
+    # `arguments` is always a fresh list, so it becomes the storage of the
+    # call environment as it is: params take the first slots, in order.
     def call(self, interpreter, arguments):
-        environment = Environment(self.closure)
-        for i in range(len(self.declaration.params)):
-            environment.define(self.declaration.params[i].lexeme,
-                               arguments[i])
-        try:
-            interpreter.execute_block(self.declaration.body, environment)
-        except ReturnError as return_value:
-            if self.is_initializer:
-                return self.closure.get_at(0, "this")
-            return return_value.value
-        
+        if self.this is not None:
+            return self.call_method(interpreter, self.this, arguments)
+
+        cells = self.declaration.cells
+        if cells:
+            box(arguments, cells)
+        completion = interpreter.execute_block(self.declaration.body,
+                                               Environment(arguments, self.upvalues))
+
+        if completion is None:
+            return None
+        if type(completion) is tuple:
+            return completion[0]
+        return interpreter.run_tail_calls(completion)
+
+    # same as bind(instance).call(interpreter, arguments), but without
+    # allocating the bound method object. used for `obj.method(args)`.
+    # (not written as bind + call on purpose, every extra python frame here
+    # costs us recursion depth in lox code.)
+    def call_method(self, interpreter, instance, arguments):
+        # "this" takes the first slot
+        arguments.insert(0, instance)
+        cells = self.declaration.cells
+        if cells:
+            box(arguments, cells)
+        completion = interpreter.execute_block(self.declaration.body,
+                                               Environment(arguments, self.upvalues))
+
         if self.is_initializer:
-            return self.closure.get_at(0, "this")
-        
-        return None
+            return instance
+
+        if completion is None:
+            return None
+        if type(completion) is tuple:
+            return completion[0]
+        return interpreter.run_tail_calls(completion)
     
     def bind(self, instance):
-        environment = Environment(self.closure)
-        environment.define("this", instance)
-        return LoxFunction(self.declaration, environment, self.is_initializer)
+        return LoxFunction(self.declaration, self.upvalues, self.is_initializer, instance)
     
     def arity(self):
         return len(self.declaration.params)
     
     def __str__(self):
         return "<fn " + self.declaration.name.lexeme + ">"
-
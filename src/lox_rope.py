@@ -0,0 +1,81 @@
+# lazy string for long concatenations.
+#
+# `s = s + x` in a loop copies all of `s` on every iteration with plain python
+# strings, so building a long string that way is quadratic. once the result
+# of a `+` gets long, it becomes a LoxRope instead: a list of pieces that is
+# only joined into one string (and then kept that way) when the text is
+# actually needed, for printing or for comparing with `==`. `+` with a rope
+# on the left just adds a piece. the length is tracked, so the `<`/`>` string
+# comparisons don't have to join anything.
+#
+# ropes are values like strings and never change. appending to a rope hands
+# its piece list on to the new rope; a rope whose list was taken over already
+# (`a = s + "x"; b = s + "y"`) copies its own pieces before appending.
+
+# shortest concatenation result that becomes a rope, copying shorter strings
+# is cheaper than keeping pieces around.
+ROPE_MIN_LENGTH = 1024
+
+
+class LoxRope:
+    __slots__ = ("parts", "count", "length")
+
+    def __init__(self, parts, length):
+        self.parts = parts
+        self.count = len(parts) # pieces of `parts` that belong to this rope
+        self.length = length
+
+    def append(self, text):
+        if type(text) is LoxRope:
+            text = text.flatten()
+
+        parts = self.parts
+        if len(parts) != self.count:
+            parts = parts[:self.count]
+        parts.append(text)
+        return LoxRope(parts, self.length + len(text))
+
+    def prepend(self, text):
+        return LoxRope([text] + self.parts[:self.count], len(text) + self.length)
+
+    # the whole text, joined once and kept.
+    def flatten(self):
+        if self.count != 1:
+            # a new list, other ropes may still be using the old one
+            self.parts = ["".join(self.parts[:self.count])]
+            self.count = 1
+        return self.parts[0]
+
+    def __str__(self):
+        return self.flatten()
+
+    def __len__(self):
+        return self.length
+
+    # a rope is equal to the string (or rope) with the same text
+    def __eq__(self, other):
+        if type(other) is LoxRope:
+            other = other.flatten()
+        if type(other) is not str:
+            return NotImplemented
+        return self.flatten() == other
+
+    def __hash__(self):
+        return hash(self.flatten())
+
+
+# types a lox string value can have
+STRING_TYPES = (str, LoxRope)
+
+
+# `left + right` for two strings (str or LoxRope).
+def concatenate(left, right):
+    if type(left) is LoxRope:
+        return left.append(right)
+    if type(right) is LoxRope:
+        return right.prepend(left)
+
+    length = len(left) + len(right)
+    if length < ROPE_MIN_LENGTH:
+        return left + right
+    return LoxRope([left, right], length)
@@ -1,5 +1,7 @@
+import re
+
 from token_type import TokenType
-from lox_token import Token
+from lox_token import TokenBuffer, make_token
 from error_handler import Lox
 
 # all keywords in lox
@@ -23,156 +25,103 @@ KEYWORDS = {
     "while" :  TokenType.WHILE
 }
 
+# one and two character tokens
+OPERATORS = {
+    "(" : TokenType.LEFT_PAREN,
+    ")" : TokenType.RIGHT_PAREN,
+    "{" : TokenType.LEFT_BRACE,
+    "}" : TokenType.RIGHT_BRACE,
+    "," : TokenType.COMMA,
+    "." : TokenType.DOT,
+    "-" : TokenType.MINUS,
+    "+" : TokenType.PLUS,
+    ";" : TokenType.SEMICOLON,
+    "*" : TokenType.STAR,
+    "/" : TokenType.SLASH,
+    "!" : TokenType.BANG,
+    "!=": TokenType.BANG_EQUAL,
+    "=" : TokenType.EQUAL,
+    "==": TokenType.EQUAL_EQUAL,
+    "<" : TokenType.LESS,
+    "<=": TokenType.LESS_EQUAL,
+    ">" : TokenType.GREATER,
+    ">=": TokenType.GREATER_EQUAL,
+}
+
+# every lexeme in one compiled pattern, tried in this order at each position.
+# the last alternative matches any other single character, so the matches of
+# finditer() follow each other without gaps and cover the whole source.
+# (only ascii letters and digits, `\d` and `\w` would take unicode ones too.)
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>[ \r\t]+)
+  | (?P<newline>\n)
+  | (?P<identifier>[A-Za-z_][A-Za-z_0-9]*)
+  | (?P<number>[0-9]+(?:\.[0-9]+)?)
+  | (?P<comment>//[^\n]*)
+  | (?P<operator>[!=<>]=?|[(){},.\-+;*/])
+  | (?P<string>"[^"]*"?)
+  | (?P<unexpected>.)
+""", re.VERBOSE)
+
+
 class Scanner:
     def __init__(self, source):
         self.source = source
-
-        self.start=0
-        self.current = 0
         self.line = 1
-
         self.tokens = []
 
     def scan_tokens(self):
-        while not self.is_at_end():
-            self.start = self.current
-            self.scan_token()
-
-        self.tokens.append(Token(TokenType.EOF, "", None, self.line))
+        self.tokens = list(self.iter_tokens())
         return self.tokens
-    
-    def is_at_end(self):
-        return self.current >= len(self.source)
-
-    def scan_token(self):
-        char = self.advance()
-        
-        match char:
-            # single tokens
-            case '(':
-                self.add_token(TokenType.LEFT_PAREN)
-            case ')':
-                self.add_token(TokenType.RIGHT_PAREN)
-            case '{':
-                self.add_token(TokenType.LEFT_BRACE)
-            case '}': 
-                self.add_token(TokenType.RIGHT_BRACE)
-            case ',': 
-                self.add_token(TokenType.COMMA)
-            case '.': 
-                self.add_token(TokenType.DOT)
-            case '-': 
-                self.add_token(TokenType.MINUS)
-            case '+': 
-                self.add_token(TokenType.PLUS)
-            case ';': 
-                self.add_token(TokenType.SEMICOLON)
-            case '*': 
-                self.add_token(TokenType.STAR)
-            # operators 
-            case '!':
-                self.add_token(TokenType.BANG_EQUAL if self.match('=') else TokenType.BANG)
-            case '=':
-                self.add_token(TokenType.EQUAL_EQUAL if self.match('=') else TokenType.EQUAL)
-            case '<':
-                self.add_token(TokenType.LESS_EQUAL if self.match('=') else TokenType.LESS)
-            case '>':
-                self.add_token(TokenType.GREATER_EQUAL if self.match('=') else TokenType.GREATER)
-            # comments 
-            case '/':
-                if self.match('/'):
-                    while self.peek() != '\n' and not self.is_at_end():
-                        self.advance()
-                else:
-                    self.add_token(TokenType.SLASH)
-            # Ignore whitespace
-            case ' ' | '\r' | '\t':
-                pass
-            case '\n':
-                self.line += 1
-            # string
-            case '"':
-                self.string()
-            # default case
-            case _: 
-                if self.is_digit(char):
-                    self.number()
-                elif self.is_alpha(char):
-                    self.identifier()
-                else:
-                    Lox.error(self.line, "Unexpected character.")
-
-    def advance(self):
-        self.current += 1
-        return self.source[self.current - 1]
-    
-    def add_token(self, token_type, literal=None):
-        text = self.source[self.start: self.current]
-        self.tokens.append(Token(token_type, text, literal, self.line))
-
-    def match(self, expected):
-        if self.is_at_end():
-            return False
-        if self.source[self.current] != expected:
-            return False
-        
-        self.current += 1
-        return True
-
-    def peek(self):
-        if self.is_at_end():
-            return '\0'
-        return self.source[self.current]
-
-    def string(self):
-        while self.peek() != '"' and not self.is_at_end():
-            if self.peek() == '\n':
-                self.line += 1
-            self.advance()
-
-        if self.is_at_end():
-            Lox.error(self.line, "Unterminated string.")
-            return
-        
-        self.advance()
-        value = self.source[self.start+1 : self.current-1]
-        self.add_token(TokenType.STRING, value)
-
-    def is_digit(self, char):
-        return '0' <= char <= '9'
-
-    def number(self):
-        while self.is_digit(self.peek()):
-            self.advance()
-
-        # Look for a fractional part.
-        if self.peek() == '.' and self.is_digit(self.peek_next()):
-            # Consume the "."
-            self.advance()
-
-            while self.is_digit(self.peek()):
-                self.advance()
-
-        # Extract the number string and convert it to a float
-        value = float(self.source[self.start : self.current])
-        self.add_token(TokenType.NUMBER, value)
-
-    def peek_next(self):
-        if self.current + 1 >= len(self.source):
-            return '\0'
-        return self.source[self.current + 1]
-    
-    def identifier(self):
-        while self.is_alpha_numeric(self.peek()):
-            self.advance()
-
-        text = self.source[self.start : self.current]
-        token_type = KEYWORDS.get(text, TokenType.IDENTIFIER)
-
-        self.add_token(token_type)
 
-    def is_alpha(self, char):
-        return ('a' <= char <= 'z') or ('A' <= char <= 'Z') or char == '_'
-    
-    def is_alpha_numeric(self, char):
-        return self.is_alpha(char) or self.is_digit(char)
+    # all the tokens in a TokenBuffer, which is what the Parser reads.
+    def scan_buffer(self):
+        buffer = TokenBuffer(self.source)
+        append = buffer.append
+        for token_type, start, end, line in self.lexemes():
+            append(token_type, start, end, line)
+        return buffer
+
+    # yields the tokens one at a time, as they are found, ending with EOF.
+    def iter_tokens(self):
+        source = self.source
+        for token_type, start, end, line in self.lexemes():
+            yield make_token(token_type, source[start:end], line)
+
+    # yields (token type, start, end, line) for every token, ending with EOF.
+    # errors are reported on the way.
+    def lexemes(self):
+        line = 1
+        keywords = KEYWORDS
+        operators = OPERATORS
+
+        for match in TOKEN_PATTERN.finditer(self.source):
+            kind = match.lastgroup
+
+            if kind == "space" or kind == "comment":
+                continue
+            if kind == "newline":
+                line += 1
+                continue
+
+            start, end = match.span()
+            if kind == "identifier":
+                yield keywords.get(match.group(), TokenType.IDENTIFIER), start, end, line
+            elif kind == "operator":
+                yield operators[match.group()], start, end, line
+            elif kind == "number":
+                yield TokenType.NUMBER, start, end, line
+            elif kind == "string":
+                # strings can span lines, the token gets the line it ends on
+                text = match.group()
+                line += text.count("\n")
+                if len(text) == 1 or text[-1] != '"':
+                    Lox.error(line, "Unterminated string.")
+                    continue
+                yield TokenType.STRING, start, end, line
+            else:
+                Lox.error(line, "Unexpected character.")
+
+        self.line = line
+        end = len(self.source)
+        yield TokenType.EOF, end, end, line
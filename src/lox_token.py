@@ -1,3 +1,5 @@
+import sys
+from array import array
 from dataclasses import dataclass
 from typing import Any
 from token_type import TokenType
@@ -11,6 +13,67 @@ class Token:
     literal: Any
     line_no: int
 
+    # tokens of a cached syntax tree (see ast_cache.py) go through make_token
+    # when they are loaded, so their names are interned again.
+    def __reduce__(self):
+        return make_token, (self.token_type, self.lexeme, self.line_no)
+
 
     def __str__(self):
         return f"{self.token_type} {self.lexeme} {self.literal}"
+
+
+# the tokens of one source, stored column by column: a type code (the
+# TokenType's value), where the lexeme starts and ends in the source and the
+# line, each in its own array. that's a few bytes per token instead of a Token
+# object and a string. Token objects (and their lexemes) are only created for
+# the tokens the parser asks for.
+class TokenBuffer:
+    def __init__(self, source):
+        self.source = source
+        self.types = array("B")
+        self.starts = array("i")
+        self.ends = array("i")
+        self.lines = array("i")
+
+    def append(self, token_type, start, end, line):
+        self.types.append(token_type.code)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.lines.append(line)
+
+    def __len__(self):
+        return len(self.types)
+
+    # the value of a NUMBER or STRING token, without making the Token
+    def literal(self, index):
+        lexeme = self.source[self.starts[index]:self.ends[index]]
+        if self.types[index] == TokenType.NUMBER.code:
+            return float(lexeme)
+        return lexeme[1:-1]
+
+    def token(self, index):
+        lexeme = self.source[self.starts[index]:self.ends[index]]
+        return make_token(TOKEN_TYPES[self.types[index]], lexeme, self.lines[index])
+
+
+# a Token for a lexeme, with its literal value.
+#
+# names (identifiers and keywords) are interned: every `x` in the program
+# ends up as the same string object, that's also the one that becomes the key
+# in dicts like LoxClass.methods, the global names or the shapes of
+# instances. looking a name up then matches on identity without comparing
+# characters, and a name used a thousand times is stored once.
+def make_token(token_type, lexeme, line):
+    literal = None
+    if token_type == TokenType.NUMBER:
+        literal = float(lexeme)
+    elif token_type == TokenType.STRING:
+        literal = lexeme[1:-1]
+    else:
+        lexeme = sys.intern(lexeme)
+    return Token(token_type, lexeme, literal, line)
+
+
+# type code -> TokenType
+TOKEN_TYPES = {token_type.value: token_type for token_type in TokenType}
@@ -0,0 +1,287 @@
+from Expr import *
+from stmt import *
+from token_type import TokenType
+from lox_runtime_error import LoxRuntimeError
+from lox_rope import LoxRope
+from resolver import DroppedCodeResolver, FunctionType, ClassType
+
+# optimization pass that runs between the Parser and the Resolver.
+#
+# it rebuilds the syntax tree with every subtree that only works on literals
+# folded into a single Literal, so `60 * 60 * 24` is computed once here and
+# not on every loop iteration. on top of that it strips Grouping nodes (they
+# only matter to the parser) and drops if/while branches whose condition is
+# a literal and therefore can never run. static errors in dropped code are
+# still reported: the code goes through a DroppedCodeResolver, for which this
+# pass keeps track of the function, class and variable it's in.
+#
+# folding uses the interpreter's own helpers, so a folded value is exactly
+# what the interpreter would have computed. an operation that would fail
+# (like `1 / 0` or `-"a"`) is left in the tree as is and still reports its
+# error, at its own line, when it runs.
+#
+# only literal operands are folded. identities like `x * 1` or `x + 0` are
+# not, since `x` could be a string (or something else) at runtime.
+#
+# it also fuses the two patterns every counted `for` loop is made of into
+# single nodes: `i = i + 1` (or `- <number>`) becomes an Increment and
+# `i < 10` (any comparison of a variable with a number) becomes a Compare.
+# the interpreter runs those with one variable access and no nested visits.
+
+# comparisons that can be fused into a Compare node
+COMPARISONS = (
+    TokenType.GREATER,
+    TokenType.GREATER_EQUAL,
+    TokenType.LESS,
+    TokenType.LESS_EQUAL,
+)
+
+class Optimizer(VisitorExpr, VisitorStmt):
+    def __init__(self, interpreter):
+        # for binary_operation, is_truthy, ...
+        self.interpreter = interpreter
+
+        # where we are, for checking dropped code
+        self.current_function = FunctionType.NONE
+        self.current_class = ClassType.NONE
+        self.depth = 0 # functions and blocks we are in
+        self.initializing = None # name of the local variable being declared
+
+    # API to use by other programs.
+
+    # takes what Parser.parse (a list of statements) or Parser.parse_repl
+    # (statements or a single expression) returned.
+    def optimize(self, syntax):
+        if isinstance(syntax, list):
+            return self.optimize_statements(syntax)
+        return self.fold(syntax)
+
+    ##############
+    ## expressions
+    ##############
+
+    def visit_literal_expr(self, expr):
+        return expr
+
+    def visit_grouping_expr(self, expr):
+        return self.fold(expr.expression)
+
+    def visit_unary_expr(self, expr):
+        right = self.fold(expr.right)
+
+        if isinstance(right, Literal):
+            if expr.operator.token_type == TokenType.BANG:
+                return Literal(not self.interpreter.is_truthy(right.value))
+            # negating anything but a number is a runtime error, keep it
+            if isinstance(right.value, float):
+                return Literal(-right.value)
+
+        return Unary(expr.operator, right)
+
+    def visit_binary_expr(self, expr):
+        left = self.fold(expr.left)
+        right = self.fold(expr.right)
+
+        if isinstance(left, Literal) and isinstance(right, Literal):
+            try:
+                value = self.interpreter.binary_operation(expr.operator, left.value, right.value)
+                if isinstance(value, LoxRope):
+                    # literals hold plain strings
+                    value = value.flatten()
+                return Literal(value)
+            except LoxRuntimeError:
+                # fails at runtime too, let it fail there
+                pass
+
+        if (expr.operator.token_type in COMPARISONS and isinstance(left, Variable)
+                and self.is_number(right)):
+            return Compare(left.name, expr.operator, right.value)
+
+        return Binary(left, expr.operator, right)
+
+    def visit_logical_expr(self, expr):
+        left = self.fold(expr.left)
+
+        if isinstance(left, Literal):
+            truthy = self.interpreter.is_truthy(left.value)
+            # `or` keeps a truthy left side, `and` keeps a falsey one,
+            # otherwise the result is whatever the right side evaluates to.
+            if truthy == (expr.operator.token_type == TokenType.OR):
+                self.check_dropped(expr.right)
+                return left
+            return self.fold(expr.right)
+
+        return Logical(left, expr.operator, self.fold(expr.right))
+
+    def visit_call_expr(self, expr):
+        return Call(self.fold(expr.callee), expr.paren,
+                    [self.fold(argument) for argument in expr.arguments])
+
+    def visit_variable_expr(self, expr):
+        return expr
+
+    def visit_assign_expr(self, expr):
+        value = self.fold(expr.value)
+
+        # `i = i + <number>` or `i = i - <number>`
+        if (isinstance(value, Binary)
+                and value.operator.token_type in (TokenType.PLUS, TokenType.MINUS)
+                and isinstance(value.left, Variable)
+                and value.left.name.lexeme == expr.name.lexeme
+                and self.is_number(value.right)):
+            amount = value.right.value
+            # `i - n` is `i + -n` for numbers, the only case the step is used for
+            step = amount if value.operator.token_type == TokenType.PLUS else -amount
+            return Increment(expr.name, value.operator, amount, step)
+
+        return Assign(expr.name, value)
+
+    def visit_get_expr(self, expr):
+        return Get(self.fold(expr.object), expr.name)
+
+    def visit_set_expr(self, expr):
+        return Set(self.fold(expr.object), expr.name, self.fold(expr.value))
+
+    def visit_super_expr(self, expr):
+        return expr
+
+    def visit_this_expr(self, expr):
+        return expr
+
+    # only created by this pass, there is nothing left to do for them.
+    def visit_compare_expr(self, expr):
+        return expr
+
+    def visit_increment_expr(self, expr):
+        return expr
+
+    # only created by the LoopOptimizer, which runs after us.
+    def visit_memo_expr(self, expr):
+        return expr
+
+    #############
+    ## statement
+    #############
+
+    # statements return the optimized statement, or None when they are gone.
+
+    def visit_expression_stmt(self, stmt):
+        return Expression(self.fold(stmt.expression))
+
+    def visit_print_stmt(self, stmt):
+        return Print(self.fold(stmt.expression))
+
+    def visit_var_stmt(self, stmt):
+        initializer = None
+        if stmt.initializer is not None:
+            # globals can be read in their own initializer
+            if self.depth > 0:
+                self.initializing = stmt.name
+            initializer = self.fold(stmt.initializer)
+            self.initializing = None
+        return Var(stmt.name, initializer)
+
+    def visit_block_stmt(self, stmt):
+        self.depth += 1
+        statements = self.optimize_statements(stmt.statements)
+        self.depth -= 1
+        return Block(statements)
+
+    def visit_if_stmt(self, stmt):
+        condition = self.fold(stmt.condition)
+
+        if isinstance(condition, Literal):
+            # if bodies are never declarations, so dropping one of them (or
+            # unwrapping the other) doesn't change any scopes.
+            if self.interpreter.is_truthy(condition.value):
+                if stmt.else_branch is not None:
+                    self.check_dropped(stmt.else_branch)
+                return self.optimize_statement(stmt.then_branch)
+            self.check_dropped(stmt.then_branch)
+            if stmt.else_branch is not None:
+                return self.optimize_statement(stmt.else_branch)
+            return None
+
+        else_branch = None
+        if stmt.else_branch is not None:
+            else_branch = self.optimize_body(stmt.else_branch)
+        return If(condition, self.optimize_body(stmt.then_branch), else_branch)
+
+    def visit_while_stmt(self, stmt):
+        condition = self.fold(stmt.condition)
+
+        if isinstance(condition, Literal) and not self.interpreter.is_truthy(condition.value):
+            self.check_dropped(stmt.body)
+            return None
+
+        return While(condition, self.optimize_body(stmt.body))
+
+    def visit_break_stmt(self, stmt):
+        return stmt
+
+    def visit_return_stmt(self, stmt):
+        value = None
+        if stmt.value is not None:
+            value = self.fold(stmt.value)
+        return Return(stmt.keyword, value)
+
+    def visit_function_stmt(self, stmt):
+        return self.optimize_function(stmt, FunctionType.FUNCTION)
+
+    def visit_class_stmt(self, stmt):
+        enclosing_class = self.current_class
+        self.current_class = ClassType.CLASS if stmt.superclass is None else ClassType.SUBCLASS
+
+        methods = []
+        for method in stmt.methods:
+            function_type = FunctionType.METHOD
+            if method.name.lexeme == "init":
+                function_type = FunctionType.INITIALIZER
+            methods.append(self.optimize_function(method, function_type))
+
+        self.current_class = enclosing_class
+        return Class(stmt.name, stmt.superclass, methods)
+
+    ####################
+    ## helper functions
+    ####################
+
+    def fold(self, expr):
+        return expr.accept(self)
+
+    def is_number(self, expr):
+        return isinstance(expr, Literal) and isinstance(expr.value, float)
+
+    def optimize_statement(self, stmt):
+        return stmt.accept(self)
+
+    def optimize_statements(self, statements):
+        optimized = []
+        for statement in statements:
+            statement = self.optimize_statement(statement)
+            if statement is not None:
+                optimized.append(statement)
+        return optimized
+
+    def optimize_function(self, stmt, function_type):
+        enclosing_function = self.current_function
+        self.current_function = function_type
+        self.depth += 1
+        body = self.optimize_statements(stmt.body)
+        self.depth -= 1
+        self.current_function = enclosing_function
+        return Function(stmt.name, stmt.params, body)
+
+    # code that can never run is dropped, its static errors are reported all
+    # the same.
+    def check_dropped(self, syntax):
+        resolver = DroppedCodeResolver(self.interpreter, self.current_function,
+                                       self.current_class, self.depth > 0, self.initializing)
+        resolver.resolve(syntax)
+
+    # for places where a statement has to stay, like the body of a loop.
+    def optimize_body(self, stmt):
+        stmt = self.optimize_statement(stmt)
+        if stmt is None:
+            return Block([])
+        return stmt
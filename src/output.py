@@ -0,0 +1,66 @@
+import sys
+
+# where lox `print` statements write to. every engine calls
+# `interpreter.output.write_line(text)` and the Interpreter flushes the
+# output when it stops running code: after the program (or a REPL line) is
+# done and before a runtime error is reported, so the error shows up after
+# everything printed before it.
+#
+# an embedding program can pass its own output to the Interpreter, anything
+# with write_line(text) and flush() works (see CapturedOutput).
+
+# characters collected before BufferedOutput writes them out
+BUFFER_SIZE = 64 * 1024
+
+
+# collects printed lines and writes them to the stream in big chunks,
+# instead of one write per `print` like python's print() does.
+class BufferedOutput:
+    def __init__(self, stream=None, line_buffered=None, buffer_size=BUFFER_SIZE):
+        # None is whatever sys.stdout is at the time of writing, so
+        # redirecting sys.stdout still works.
+        self.stream = stream
+        # line buffered writes every line right away. None picks it when
+        # writing to a terminal, like python does for stdout.
+        self.line_buffered = line_buffered
+        self.buffer_size = buffer_size
+
+        self.lines = []
+        self.size = 0
+
+    def write_line(self, text):
+        self.lines.append(text)
+        self.size += len(text) + 1
+        if self.size >= self.buffer_size or self.is_line_buffered():
+            self.flush()
+
+    def flush(self):
+        stream = self.stream if self.stream is not None else sys.stdout
+        if self.lines:
+            self.lines.append("")
+            stream.write("\n".join(self.lines))
+            self.lines.clear()
+            self.size = 0
+        stream.flush()
+
+    def is_line_buffered(self):
+        if self.line_buffered is None:
+            stream = self.stream if self.stream is not None else sys.stdout
+            self.line_buffered = stream.isatty()
+        return self.line_buffered
+
+
+# keeps the printed lines in memory, for programs that run lox code and
+# want its output.
+class CapturedOutput:
+    def __init__(self):
+        self.lines = []
+
+    def write_line(self, text):
+        self.lines.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return "".join(line + "\n" for line in self.lines)
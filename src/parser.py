@@ -1,5 +1,5 @@
 from token_type import TokenType
-from lox_token import Token
+from lox_token import TokenBuffer
 from Expr import *
 from stmt import *
 from error_handler import Lox
@@ -7,9 +7,23 @@ from error_handler import Lox
 class ParseError(RuntimeError):
     pass
 
+EOF = TokenType.EOF.code
+SEMICOLON = TokenType.SEMICOLON.code
+
+# tokens a statement can start with, synchronize stops before them
+STATEMENT_STARTS = frozenset(token_type.code for token_type in (
+    TokenType.CLASS, TokenType.FUN, TokenType.VAR,
+    TokenType.FOR, TokenType.IF, TokenType.WHILE,
+    TokenType.PRINT, TokenType.RETURN
+))
+
 class Parser:
-    def __init__(self, tokens: list[Token]):
+    def __init__(self, tokens: TokenBuffer):
         self.tokens = tokens
+        # type codes of the tokens (see TokenType.code), checking a token
+        # doesn't have to create it. Token objects are only made for the
+        # tokens that end up in the syntax tree or in an error message.
+        self.types = tokens.types
 
         self.current = 0
         self.loop_depth = 0 # to keep the track of scope
@@ -63,7 +77,8 @@ class Parser:
     ###############
 
     def class_declaration(self):
-        name = self.consume(TokenType.IDENTIFIER, "Expect class name.")
+        self.consume(TokenType.IDENTIFIER, "Expect class name.")
+        name = self.previous()
 
         superclass = None
         if self.match(TokenType.LESS):
@@ -80,26 +95,37 @@ class Parser:
         return Class(name, superclass, methods)
 
     def function_(self, kind):
-        name = self.consume(TokenType.IDENTIFIER, f"expect {kind} name.")
+        self.consume(TokenType.IDENTIFIER, f"expect {kind} name.")
+        name = self.previous()
         self.consume(TokenType.LEFT_PAREN, f"Expect '(' after {kind} name.")
         parameters = []
 
         if not self.check(TokenType.RIGHT_PAREN):
-            parameters.append(self.consume(TokenType.IDENTIFIER, "Expect parameter name."))
+            self.consume(TokenType.IDENTIFIER, "Expect parameter name.")
+            parameters.append(self.previous())
             
             while(self.match(TokenType.COMMA)):
                 if len(parameters) >= 255:
                     self.error(self.peek(), "Can't have more than 255 parameters.")
 
-                parameters.append(self.consume(TokenType.IDENTIFIER, "Expect parameter name."))
+                self.consume(TokenType.IDENTIFIER, "Expect parameter name.")
+                parameters.append(self.previous())
         self.consume(TokenType.RIGHT_PAREN, "Expect ')' after parameters.")
 
         self.consume(TokenType.LEFT_BRACE, "Expect '{' before " + kind + " body.")
-        body = self.block()
+        # a function body is never inside the loop the function is declared
+        # in, `break` there is an error like at the top level.
+        loop_depth = self.loop_depth
+        self.loop_depth = 0
+        try:
+            body = self.block()
+        finally:
+            self.loop_depth = loop_depth
         return Function(name, parameters, body)
     
     def var_declaration(self):
-        name = self.consume(TokenType.IDENTIFIER, "Expect variable name.")
+        self.consume(TokenType.IDENTIFIER, "Expect variable name.")
+        name = self.previous()
 
         initializer = None
         if self.match(TokenType.EQUAL):
@@ -248,7 +274,7 @@ class Parser:
         expr = self.or_()
 
         if self.match(TokenType.EQUAL):
-            equals = self.previous()
+            equals = self.current - 1
             value = self.assignment()
             if isinstance(expr, Variable):
                 name = expr.name
@@ -256,7 +282,7 @@ class Parser:
             elif isinstance(expr, Get):
                 return Set(expr.object, expr.name, value)
         
-            self.error(equals, "Invalid assignment target.")
+            self.error(self.tokens.token(equals), "Invalid assignment target.")
         return expr
     
     def or_(self):
@@ -336,9 +362,9 @@ class Parser:
             if self.match(TokenType.LEFT_PAREN):
                 expr = self.finish_call(expr)
             elif self.match(TokenType.DOT):
-                name = self.consume(TokenType.IDENTIFIER, 
-                                    "Expect property name after '.'.")
-                expr = Get(expr, name) # keeps running code until their is no dot which means we have reached final variable for which we need value.
+                self.consume(TokenType.IDENTIFIER, 
+                             "Expect property name after '.'.")
+                expr = Get(expr, self.previous()) # keeps running code until their is no dot which means we have reached final variable for which we need value.
             else:
                 break
         
@@ -353,7 +379,8 @@ class Parser:
                     self.error(self.peek(), "Can't have more than 255 arguments.")
                 arguments.append(self.expression())
 
-        paren = self.consume(TokenType.RIGHT_PAREN, "Expect ')' after arguments.")
+        self.consume(TokenType.RIGHT_PAREN, "Expect ')' after arguments.")
+        paren = self.previous()
         return Call(callee, paren, arguments)
     
     def primary(self):
@@ -364,11 +391,12 @@ class Parser:
         if self.match(TokenType.NIL):
             return Literal(None)
         if self.match(TokenType.NUMBER, TokenType.STRING):
-            return Literal(self.previous().literal)
+            return Literal(self.tokens.literal(self.current - 1))
         if self.match(TokenType.SUPER):
             keyword = self.previous()
             self.consume(TokenType.DOT, "Expect '.' after 'super'.")
-            method = self.consume(TokenType.IDENTIFIER, "Expect superclass method name.")
+            self.consume(TokenType.IDENTIFIER, "Expect superclass method name.")
+            method = self.previous()
             return Super(keyword, method)
         if self.match(TokenType.THIS):
             return This(self.previous())
@@ -386,35 +414,40 @@ class Parser:
     ###########################
 
     def match(self, *token_types):
+        code = self.types[self.current]
+        # nothing ever matches EOF, so there's no need for is_at_end() here
         for typ in token_types:
-            if self.check(typ):
-                self.advance()
+            if typ.code == code:
+                self.current += 1
                 return True
-        return False        
+        return False
     
+    # the token consumed is previous() for the callers that keep it.
     def consume(self, typ, message):
         if self.check(typ):
-            return self.advance()
+            self.current += 1
+            return
         raise self.error(self.peek(), message)
 
     def check(self, typ):
-        if self.is_at_end():
-            return False
-        return self.peek().token_type == typ
+        # nothing ever checks for EOF, like in match()
+        return self.types[self.current] == typ.code
 
     def is_at_end(self):
-        return self.peek().token_type == TokenType.EOF
+        return self.types[self.current] == EOF
 
+    # moves past the current token without creating it.
     def advance(self):
         if not self.is_at_end():
             self.current += 1
-        return self.previous()
     
+    # peek() and previous() create the Token, only call them for a token that
+    # is kept or reported.
     def peek(self):
-        return self.tokens[self.current]
+        return self.tokens.token(self.current)
     
     def previous(self):
-        return self.tokens[self.current - 1]
+        return self.tokens.token(self.current - 1)
 
     def error(self, token, message):
         Lox.error(token, message)
@@ -424,13 +457,9 @@ class Parser:
         self.advance()
 
         while not self.is_at_end():
-            if self.previous().token_type == TokenType.SEMICOLON:
+            if self.types[self.current - 1] == SEMICOLON:
                 return
-            if self.peek().token_type in (
-                TokenType.CLASS, TokenType.FUN, TokenType.VAR, 
-                TokenType.FOR, TokenType.IF, TokenType.WHILE, 
-                TokenType.PRINT, TokenType.RETURN
-            ):
+            if self.types[self.current] in STATEMENT_STARTS:
                 return
             
             self.advance()
@@ -0,0 +1,272 @@
+import json
+import time
+
+from Expr import *
+from stmt import *
+from environment import Environment
+from interpreter import Interpreter
+from lox_class import LoxClass
+
+# `--profile`: runs the program on the tree-walker and records where the time
+# goes.
+#
+# every lox function body runs through Interpreter.execute_block, whichever
+# way it was called (plain call, method call, initializer of a class call,
+# tail call), so that's where a function's frame starts and ends. calling a
+# class gets a frame of its own (`Point()`), with the frame of its `init`, if
+# it has one, inside it. for every function we count the calls, the inclusive time (the call and everything
+# it called) and the exclusive time (only the function's own code). every
+# statement that runs counts a hit for its line.
+#
+# the results can be written as a report for people, as JSON, or as
+# collapsed stacks (`main;loop;fib 1234` lines, exclusive microseconds) for
+# flamegraph tools.
+
+PROFILE_FORMATS = ("report", "json", "collapsed")
+
+# frame of everything that isn't inside a function
+SCRIPT = "<script>"
+
+# how many of the most hit lines the report lists
+REPORT_LINES = 20
+
+
+class FunctionStats:
+    __slots__ = ("calls", "inclusive", "exclusive")
+
+    def __init__(self):
+        self.calls = 0
+        self.inclusive = 0 # ns
+        self.exclusive = 0 # ns
+
+
+class Frame:
+    __slots__ = ("label", "path", "start", "children")
+
+    def __init__(self, label, path, start):
+        self.label = label
+        self.path = path # labels of the frames from the outermost one, `;` separated
+        self.start = start
+        self.children = 0 # ns spent in functions called from this frame
+
+
+class Profiler:
+    def __init__(self):
+        self.functions = {} # label -> FunctionStats
+        self.lines = {} # line -> hits
+        self.stacks = {} # path -> exclusive ns
+        self.frames = []
+        # label -> how many of its frames are running. with recursion only
+        # the outermost call adds to the inclusive time, otherwise the inner
+        # calls would be counted more than once.
+        self.running = {}
+
+    def hit(self, line):
+        self.lines[line] = self.lines.get(line, 0) + 1
+
+    def enter(self, label):
+        path = label
+        if self.frames:
+            path = self.frames[-1].path + ";" + label
+        self.frames.append(Frame(label, path, time.perf_counter_ns()))
+        self.running[label] = self.running.get(label, 0) + 1
+
+    def leave(self):
+        frame = self.frames.pop()
+        elapsed = time.perf_counter_ns() - frame.start
+        exclusive = elapsed - frame.children
+
+        stats = self.functions.get(frame.label)
+        if stats is None:
+            stats = self.functions[frame.label] = FunctionStats()
+        stats.calls += 1
+        stats.exclusive += exclusive
+        self.running[frame.label] -= 1
+        if self.running[frame.label] == 0:
+            stats.inclusive += elapsed
+
+        if self.frames:
+            self.frames[-1].children += elapsed
+        self.stacks[frame.path] = self.stacks.get(frame.path, 0) + exclusive
+
+    ##########
+    ## output
+    ##########
+
+    def write(self, profile_format):
+        if profile_format == "json":
+            return self.json()
+        if profile_format == "collapsed":
+            return self.collapsed()
+        return self.report()
+
+    # functions by exclusive time, then the most hit lines
+    def report(self):
+        functions = sorted(self.functions.items(), key=lambda item: item[1].exclusive, reverse=True)
+        lines = sorted(self.lines.items(), key=lambda item: (-item[1], item[0]))
+
+        width = max([len("function")] + [len(label) for label in self.functions])
+        report = [f"{'function':<{width}} {'calls':>10} {'total ms':>12} {'self ms':>12}"]
+        for label, stats in functions:
+            report.append(f"{label:<{width}} {stats.calls:>10} "
+                          f"{stats.inclusive / 1e6:>12.3f} {stats.exclusive / 1e6:>12.3f}")
+
+        report.append("")
+        report.append(f"{'line':>8} {'hits':>10}")
+        for line, hits in lines[:REPORT_LINES]:
+            report.append(f"{line:>8} {hits:>10}")
+        return "\n".join(report) + "\n"
+
+    def json(self):
+        functions = sorted(self.functions.items(), key=lambda item: item[1].exclusive, reverse=True)
+        return json.dumps({
+            "functions": [
+                {
+                    "name": label,
+                    "calls": stats.calls,
+                    "inclusive_ms": stats.inclusive / 1e6,
+                    "exclusive_ms": stats.exclusive / 1e6,
+                }
+                for label, stats in functions
+            ],
+            "lines": [{"line": line, "hits": hits} for line, hits in sorted(self.lines.items())],
+            "stacks": {path: ns // 1000 for path, ns in self.stacks.items()},
+        }, indent=2) + "\n"
+
+    def collapsed(self):
+        return "".join(f"{path} {ns // 1000}\n" for path, ns in self.stacks.items())
+
+
+# line of the first token of an expression, None for literals
+def expression_line(expr):
+    kind = expr.kind
+    if kind in (ASSIGN_EXPR, VARIABLE_EXPR, INCREMENT_EXPR, COMPARE_EXPR):
+        return expr.name.line_no
+    if kind in (BINARY_EXPR, LOGICAL_EXPR):
+        line = expression_line(expr.left)
+        return line if line is not None else expr.operator.line_no
+    if kind == UNARY_EXPR:
+        return expr.operator.line_no
+    if kind == CALL_EXPR:
+        return expression_line(expr.callee)
+    if kind in (GET_EXPR, SET_EXPR):
+        return expression_line(expr.object)
+    if kind in (GROUPING_EXPR, MEMO_EXPR):
+        return expression_line(expr.expression)
+    if kind in (SUPER_EXPR, THIS_EXPR):
+        return expr.keyword.line_no
+    return None
+
+# line a statement is counted on, None for the ones without a line of their
+# own (blocks, `break`, a lone literal, the LoopOptimizer's hidden variables).
+def statement_line(stmt):
+    kind = stmt.kind
+    if kind in (EXPRESSION_STMT, PRINT_STMT):
+        line = expression_line(stmt.expression)
+    elif kind in (IF_STMT, WHILE_STMT):
+        line = expression_line(stmt.condition)
+    elif kind in (VAR_STMT, FUNCTION_STMT, CLASS_STMT):
+        line = stmt.name.line_no
+    elif kind == RETURN_STMT:
+        line = stmt.keyword.line_no
+    else:
+        line = None
+    # hidden variables have line 0
+    return line or None
+
+
+# the tree-walker with a Profiler watching it.
+class ProfilingInterpreter(Interpreter):
+    def __init__(self, output=None):
+        super().__init__(output)
+        self.profiler = Profiler()
+        self.bodies = {} # id of a function's body -> (the body, its label)
+        self.statement_lines = {} # statement -> line, see statement_line
+
+    def interpret(self, syntax):
+        self.profiler.enter(SCRIPT)
+        try:
+            return super().interpret(syntax)
+        finally:
+            self.profiler.leave()
+
+    def execute(self, stmt):
+        line = self.statement_lines.get(stmt, 0)
+        if line == 0:
+            line = self.statement_lines[stmt] = statement_line(stmt)
+        if line is not None:
+            self.profiler.hit(line)
+        return stmt.accept(self)
+
+    def execute_block(self, statements, environment):
+        entry = self.bodies.get(id(statements))
+        if entry is None:
+            return self.run_statements(statements, environment)
+
+        self.profiler.enter(entry[1])
+        try:
+            return self.run_statements(statements, environment)
+        finally:
+            self.profiler.leave()
+
+    # Interpreter.execute_block, but with every statement going through execute.
+    def run_statements(self, statements, environment):
+        previous = self.environment
+        try:
+            self.environment = environment
+            for statement in statements:
+                completion = self.execute(statement)
+                if completion is not None:
+                    return completion
+            return None
+        finally:
+            self.environment = previous
+
+    # same as Interpreter.visit_block_stmt, with the statements counted.
+    def visit_block_stmt(self, stmt):
+        if not stmt.inline:
+            return self.execute_block(stmt.statements, Environment([]))
+
+        completion = None
+        for statement in stmt.statements:
+            completion = self.execute(statement)
+            if completion is not None:
+                break
+        if stmt.start is not None:
+            del self.environment.values[stmt.start:]
+        return completion
+
+    def visit_function_stmt(self, stmt):
+        self.register(stmt, stmt.name.lexeme)
+        return super().visit_function_stmt(stmt)
+
+    def visit_class_stmt(self, stmt):
+        for method in stmt.methods:
+            self.register(method, f"{stmt.name.lexeme}.{method.name.lexeme}")
+        return super().visit_class_stmt(stmt)
+
+    def register(self, declaration, name):
+        # lists can't be dict keys, so the body is found by its id. the entry
+        # keeps the body alive, otherwise the id of a body from a REPL line
+        # that's gone could be reused by a later list and get its label.
+        body = declaration.body
+        self.bodies[id(body)] = (body, f"{name} (line {declaration.name.line_no})")
+
+    def new_class(self, stmt, superclass, methods):
+        label = f"{stmt.name.lexeme}() (line {stmt.name.line_no})"
+        return ProfiledClass(stmt.name.lexeme, superclass, methods, self.profiler, label)
+
+
+# a class whose calls (creating an instance and running its init) get a frame
+class ProfiledClass(LoxClass):
+    def __init__(self, name, superclass, methods, profiler, label):
+        super().__init__(name, superclass, methods)
+        self.profiler = profiler
+        self.label = label
+
+    def call(self, interpreter, arguments):
+        self.profiler.enter(self.label)
+        try:
+            return super().call(interpreter, arguments)
+        finally:
+            self.profiler.leave()
@@ -1,8 +1,13 @@
 from enum import Enum, auto
 
-from Expr import VisitorExpr, Expr
-from stmt import VisitorStmt, Stmt
+from Expr import VisitorExpr, Expr, Call, This
+from stmt import VisitorStmt, Stmt, Var, Function, Class
 from error_handler import Lox
+from environment import LOCAL, CELL, UPVALUE
+from lox_token import Token
+from token_type import TokenType
+from lox_class import PropertyCache, SetPropertyCache
+from interpreter import BinaryCache
 
 class ClassType(Enum):
     NONE = auto()
@@ -16,10 +21,44 @@ class FunctionType(Enum):
     METHOD = auto()
 
 
+# a declared local variable.
+class Local:
+    __slots__ = ("slot", "defined", "declaration", "captured", "uses")
+
+    def __init__(self, slot, declaration):
+        self.slot = slot
+        self.defined = False
+        self.declaration = declaration # Var/Function/Class, None for params
+        self.captured = False
+        # nodes of its own function that read or write it, in case it turns
+        # out to be captured later on and they have to go through its cell
+        self.uses = []
+
+# one runtime Environment: a function call, a block at the top level or the
+# scope holding "super".
+class Frame:
+    def __init__(self, enclosing):
+        self.enclosing = enclosing
+        self.size = 0 # slots in use
+        # (is_local, index) pairs, see environment.capture
+        self.upvalues = []
+
+    def add_upvalue(self, is_local, index):
+        # a variable is captured only once, however often it's used
+        if (is_local, index) in self.upvalues:
+            return self.upvalues.index((is_local, index))
+        self.upvalues.append((is_local, index))
+        return len(self.upvalues) - 1
+
+
 class Resolver(VisitorExpr, VisitorStmt):
     def __init__(self, interpreter):
         self.interpreter = interpreter
+        # name -> Local for each scope we are in, the innermost last
         self.scopes = []
+        # parallel to scopes, the Frame each scope's variables live in. blocks
+        # share the Frame of the scope around them.
+        self.frames = []
         self.current_class = ClassType.NONE
         self.current_function = FunctionType.NONE
 
@@ -28,21 +67,47 @@ class Resolver(VisitorExpr, VisitorStmt):
     ## variables directly 
     #############################
 
+    # blocks don't need an Environment of their own at runtime:
+    #  - a block that declares nothing runs in the current environment.
+    #  - a block inside a local scope puts its variables into the slots right
+    #    after the ones of the current environment, and they are dropped
+    #    again when the block is left. closures don't hold on to the
+    #    environment, only to the cells of what they captured, so that's
+    #    safe even when the block declares functions.
+    # so loop bodies don't allocate an Environment on every iteration. only a
+    # block with declarations at the top level gets one, its variables are
+    # not globals.
     def visit_block_stmt(self, stmt):
+        if not declares_variables(stmt.statements):
+            self.resolve(stmt.statements)
+            stmt.resolve(True, None)
+            return None
+
+        if self.scopes:
+            start = self.frames[-1].size
+            self.begin_scope(inline=True)
+            self.resolve(stmt.statements)
+            self.end_scope()
+            stmt.resolve(True, start)
+            return None
+
         self.begin_scope()
         self.resolve(stmt.statements)
         self.end_scope()
+        stmt.resolve(False, None)
+        return None
 
     # variable declaration
     def visit_var_stmt(self, stmt): 
-        self.declare(stmt.name)
+        self.declare(stmt.name, stmt)
         if stmt.initializer is not None:
             self.resolve(stmt.initializer)
         self.define(stmt.name)
         return None
     
     def visit_variable_expr(self, expr):
-        if self.scopes and self.scopes[-1].get(expr.name.lexeme) is False:
+        local = self.scopes[-1].get(expr.name.lexeme) if self.scopes else None
+        if local is not None and not local.defined:
             Lox.error(expr.name, "Can't read local variable in its own initializer.")
         
         self.resolve_local(expr, expr.name)
@@ -52,10 +117,23 @@ class Resolver(VisitorExpr, VisitorStmt):
         self.resolve(expr.value)
         self.resolve_local(expr, expr.name)
         return None
+
+    # fused nodes from the Optimizer, both read the variable they are named after
+    def visit_increment_expr(self, expr):
+        return self.visit_variable_expr(expr)
+
+    def visit_compare_expr(self, expr):
+        return self.visit_variable_expr(expr)
+
+    # from the LoopOptimizer, reads (and the first time writes) its hidden variable
+    def visit_memo_expr(self, expr):
+        self.resolve(expr.expression)
+        self.resolve_local(expr, expr.name)
+        return None
     
     # function declaration
     def visit_function_stmt(self, stmt):
-        self.declare(stmt.name)
+        self.declare(stmt.name, stmt)
         self.define(stmt.name)
 
         self.resolve_function(stmt, FunctionType.FUNCTION)
@@ -96,6 +174,11 @@ class Resolver(VisitorExpr, VisitorStmt):
             if self.current_function == FunctionType.INITIALIZER:
                 Lox.error(stmt.keyword, "Can't return a value from an initializer.")
             self.resolve(stmt.value)
+
+            # `return f(args)`, nothing is left to do in this function once
+            # the call is made, so the interpreter can run it as a tail call.
+            if isinstance(stmt.value, Call) and self.current_function != FunctionType.NONE:
+                stmt.resolve(True)
         return None
 
     def visit_while_stmt(self, stmt):
@@ -106,6 +189,7 @@ class Resolver(VisitorExpr, VisitorStmt):
     def visit_binary_expr(self, expr):
         self.resolve(expr.left)
         self.resolve(expr.right)
+        expr.resolve(BinaryCache())
         return None
     
     def visit_call_expr(self, expr):
@@ -138,7 +222,7 @@ class Resolver(VisitorExpr, VisitorStmt):
         enclosing_class = self.current_class
         self.current_class = ClassType.CLASS
 
-        self.declare(stmt.name)
+        self.declare(stmt.name, stmt)
         self.define(stmt.name)
 
         # when we try to do this, `class Oops < Oops {}`
@@ -149,12 +233,14 @@ class Resolver(VisitorExpr, VisitorStmt):
             self.current_class = ClassType.SUBCLASS
             self.resolve(stmt.superclass)
 
+        # "super" gets an environment of its own around the methods, only
+        # they can capture it.
         if stmt.superclass is not None:
             self.begin_scope()
-            self.scopes[-1]["super"] = True
-
-        self.begin_scope()
-        self.scopes[-1]["this"] = True
+            super_ = Token(TokenType.SUPER, "super", None, stmt.name.line_no)
+            self.declare(super_)
+            self.define(super_)
+            self.scopes[-1]["super"].captured = True
 
         for method in stmt.methods:
             declaration = FunctionType.METHOD
@@ -162,9 +248,8 @@ class Resolver(VisitorExpr, VisitorStmt):
                 declaration = FunctionType.INITIALIZER
             self.resolve_function(method, declaration)
 
-        self.end_scope()
-
         if stmt.superclass is not None:
+            stmt.resolve(stmt.cell, self.frames[-1].upvalues)
             self.end_scope()
         self.current_class = enclosing_class
         return None
@@ -172,33 +257,50 @@ class Resolver(VisitorExpr, VisitorStmt):
     # getter
     def visit_get_expr(self, expr):
         self.resolve(expr.object)
+        # every property access site gets its own inline cache
+        expr.resolve(PropertyCache())
         return None
     
     # setter 
     def visit_set_expr(self, expr):
         self.resolve(expr.object)
         self.resolve(expr.value)
+        expr.resolve(SetPropertyCache())
         return None
     
     def visit_super_expr(self, expr):
         if self.current_class == ClassType.NONE:
             Lox.error(expr.keyword, 
                       "Can't use 'super' outside of a class.")
+            return None
         elif self.current_class != ClassType.SUBCLASS:
             Lox.error(expr.keyword, 
                       "Can't use 'super' in a class with no superclass.")
-            
-        self.resolve_local(expr, expr.keyword)
+            return None
+
+        # the method is looked up on the superclass and bound to "this", so
+        # super needs both. "super" always comes from outside the method.
+        this = This(Token(TokenType.THIS, "this", None, expr.keyword.line_no))
+        self.resolve_local(this, this.keyword)
+        scope, slot = self.lookup(None, "super")
+        expr.resolve(slot, this)
+        return None
 
     ############################
     ## tools / utility functions 
     ############################
 
-    def begin_scope(self):
+    def begin_scope(self, inline=False):
         self.scopes.append({})
+        if inline:
+            self.frames.append(self.frames[-1])
+        else:
+            self.frames.append(Frame(self.frames[-1] if self.frames else None))
 
     def end_scope(self):
-        self.scopes.pop()
+        scope = self.scopes.pop()
+        # the slots of the scope are free again
+        self.frames.pop().size -= len(scope)
 
     # keystone method (idk why i called it that)
     def resolve(self, syntax):
@@ -211,11 +313,57 @@ class Resolver(VisitorExpr, VisitorStmt):
             syntax.accept(self)
 
     def resolve_local(self, expr, name):
-        # reversed() walks the list backwards.
-        for distance, scope in enumerate(reversed(self.scopes)):
-            if name.lexeme in scope:
-                self.interpreter.resolve(expr, distance)
-                return
+        # resolution data lives on the node itself, so it goes away
+        # together with the tree it belongs to.
+        scope, slot = self.lookup(expr, name.lexeme)
+        expr.resolve(scope, slot)
+
+    # (scope, slot) of a variable as seen from the current frame, see LOCAL,
+    # CELL and UPVALUE in environment.py.
+    def lookup(self, expr, name):
+        # walks the scopes backwards, innermost first.
+        for i in range(len(self.scopes) - 1, -1, -1):
+            local = self.scopes[i].get(name)
+            if local is None:
+                continue
+
+            if self.frames[i] is not self.frames[-1]:
+                return UPVALUE, self.upvalue(self.frames[-1], self.frames[i], local)
+            if local.captured:
+                return CELL, local.slot
+            local.uses.append(expr)
+            return LOCAL, local.slot
+
+        # not found in any local scope, so it's a global. no scope, the slot
+        # points into the interpreter's global table instead.
+        return None, self.interpreter.globals_.intern(name)
+
+    # index of the upvalue for `local` (declared in `owner`) in `frame`. every
+    # frame between the two captures it too, so it can be handed down.
+    def upvalue(self, frame, owner, local):
+        if frame.enclosing is owner:
+            self.capture(local)
+            return frame.add_upvalue(True, local.slot)
+        return frame.add_upvalue(False, self.upvalue(frame.enclosing, owner, local))
+
+    # the variable moves into a cell: its declaration creates one and the
+    # code of its own function reads and writes through it.
+    def capture(self, local):
+        if local.captured:
+            return
+        local.captured = True
+
+        for expr in local.uses:
+            expr.resolve(CELL, local.slot)
+        local.uses = None
+
+        declaration = local.declaration
+        if isinstance(declaration, Var):
+            declaration.resolve(True)
+        elif isinstance(declaration, Function):
+            declaration.resolve(True, declaration.upvalues, declaration.cells)
+        elif isinstance(declaration, Class):
+            declaration.resolve(True, declaration.upvalues)
 
 
     def resolve_function(self, func, type):
@@ -223,25 +371,69 @@ class Resolver(VisitorExpr, VisitorStmt):
         self.current_function = type
 
         self.begin_scope()
+        # methods get "this" in the first slot of their environment
+        if type in (FunctionType.METHOD, FunctionType.INITIALIZER):
+            this = Token(TokenType.THIS, "this", None, func.name.line_no)
+            self.declare(this)
+            self.define(this)
+
         for param in func.params:
             self.declare(param)
             self.define(param)
 
         self.resolve(func.body)
+
+        # captured parameters get their cells when the function is called
+        params = self.scopes[-1].values()
+        cells = [local.slot for local in params if local.captured and local.declaration is None]
+        func.resolve(func.cell, self.frames[-1].upvalues, cells)
         self.end_scope()
 
         self.current_function = enclosing_function
 
-    def declare(self, name):
+    def declare(self, name, declaration=None):
         if not self.scopes:
             return 
         
         scope = self.scopes[-1]
         if name.lexeme in scope:
             Lox.error(name, "Already variable with this name in this scope.")
-        scope[name.lexeme] = False
+
+        # slots are handed out in declaration order
+        frame = self.frames[-1]
+        scope[name.lexeme] = Local(frame.size, declaration)
+        frame.size += 1
 
     def define(self, name):
         if not self.scopes:
             return
-        self.scopes[-1][name.lexeme] = True
+        self.scopes[-1][name.lexeme].defined = True
+
+
+
+def declares_variables(statements):
+    return any(isinstance(statement, (Var, Function, Class)) for statement in statements)
+
+
+# goes over code the Optimizer drops (`if (false) ...`, `false and x`), only
+# for the static errors in it. the dropped nodes are thrown away afterwards,
+# so what this writes into them doesn't matter, but names that aren't
+# declared in the dropped code itself are left alone: they don't get global
+# slots for code that never runs.
+class DroppedCodeResolver(Resolver):
+    # `local` is whether the code is inside a function or block, and
+    # `initializing` the local variable whose initializer it is part of.
+    def __init__(self, interpreter, function_type, class_type, local, initializing):
+        super().__init__(interpreter)
+        self.current_function = function_type
+        self.current_class = class_type
+        if local:
+            self.begin_scope()
+            if initializing is not None:
+                self.declare(initializing)
+
+    def lookup(self, expr, name):
+        for scope in self.scopes:
+            if name in scope:
+                return super().lookup(expr, name)
+        return None, None
@@ -1,5 +0,0 @@
-
-class ReturnError(RuntimeError):
-    def __init__(self, value):
-        super().__init__()
-        self.value = value
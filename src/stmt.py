@@ -1,5 +1,4 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 from typing import Any
 from lox_token import Token
 from Expr import * # manually add this line
@@ -45,85 +44,172 @@ class VisitorStmt(ABC):
     def visit_while_stmt(self, stmt: 'While') -> Any:
         pass
 
+# `kind` of each Stmt node class
+BLOCK_STMT = 100
+BREAK_STMT = 101
+CLASS_STMT = 102
+EXPRESSION_STMT = 103
+FUNCTION_STMT = 104
+IF_STMT = 105
+PRINT_STMT = 106
+RETURN_STMT = 107
+VAR_STMT = 108
+WHILE_STMT = 109
+
 class Stmt(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def accept(self, visitor: VisitorStmt) -> Any:
         pass
 
-@dataclass(frozen=True)
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
 class Block(Stmt):
-    statements: list[Stmt]
+    __slots__ = ("statements", "inline", "start")
+    kind = BLOCK_STMT
+
+    def __init__(self, statements: list[Stmt]):
+        self.statements = statements
+        # filled in by the resolver, None until then
+        self.inline = None
+        self.start = None
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_block_stmt(self)
 
-@dataclass(frozen=True)
+    def resolve(self, inline, start):
+        # the only place that writes to a node after parsing
+        self.inline = inline
+        self.start = start
+
 class Break(Stmt):
+    __slots__ = ()
+    kind = BREAK_STMT
+
+    def __init__(self):
+        pass
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_break_stmt(self)
 
-@dataclass(frozen=True)
 class Class(Stmt):
-    name: Token
-    superclass: Variable
-    methods: list['Function']
+    __slots__ = ("name", "superclass", "methods", "cell", "upvalues")
+    kind = CLASS_STMT
+
+    def __init__(self, name: Token, superclass: Variable, methods: list['Function']):
+        self.name = name
+        self.superclass = superclass
+        self.methods = methods
+        # filled in by the resolver, None until then
+        self.cell = None
+        self.upvalues = None
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_class_stmt(self)
 
-@dataclass(frozen=True)
+    def resolve(self, cell, upvalues):
+        # the only place that writes to a node after parsing
+        self.cell = cell
+        self.upvalues = upvalues
+
 class Expression(Stmt):
-    expression: Expr
+    __slots__ = ("expression",)
+    kind = EXPRESSION_STMT
+
+    def __init__(self, expression: Expr):
+        self.expression = expression
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_expression_stmt(self)
 
-@dataclass(frozen=True)
 class Function(Stmt):
-    name: Token
-    params: list[Token]
-    body: list[Stmt]
+    __slots__ = ("name", "params", "body", "cell", "upvalues", "cells")
+    kind = FUNCTION_STMT
+
+    def __init__(self, name: Token, params: list[Token], body: list[Stmt]):
+        self.name = name
+        self.params = params
+        self.body = body
+        # filled in by the resolver, None until then
+        self.cell = None
+        self.upvalues = None
+        self.cells = None
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_function_stmt(self)
 
-@dataclass(frozen=True)
+    def resolve(self, cell, upvalues, cells):
+        # the only place that writes to a node after parsing
+        self.cell = cell
+        self.upvalues = upvalues
+        self.cells = cells
+
 class If(Stmt):
-    condition: Expr
-    then_branch: Stmt
-    else_branch: Stmt
+    __slots__ = ("condition", "then_branch", "else_branch")
+    kind = IF_STMT
+
+    def __init__(self, condition: Expr, then_branch: Stmt, else_branch: Stmt):
+        self.condition = condition
+        self.then_branch = then_branch
+        self.else_branch = else_branch
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_if_stmt(self)
 
-@dataclass(frozen=True)
 class Print(Stmt):
-    expression: Expr
+    __slots__ = ("expression",)
+    kind = PRINT_STMT
+
+    def __init__(self, expression: Expr):
+        self.expression = expression
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_print_stmt(self)
 
-@dataclass(frozen=True)
 class Return(Stmt):
-    keyword: Token
-    value: Expr
+    __slots__ = ("keyword", "value", "tail_call")
+    kind = RETURN_STMT
+
+    def __init__(self, keyword: Token, value: Expr):
+        self.keyword = keyword
+        self.value = value
+        # filled in by the resolver, None until then
+        self.tail_call = None
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_return_stmt(self)
 
-@dataclass(frozen=True)
+    def resolve(self, tail_call):
+        # the only place that writes to a node after parsing
+        self.tail_call = tail_call
+
 class Var(Stmt):
-    name: Token
-    initializer: Expr
+    __slots__ = ("name", "initializer", "cell")
+    kind = VAR_STMT
+
+    def __init__(self, name: Token, initializer: Expr):
+        self.name = name
+        self.initializer = initializer
+        # filled in by the resolver, None until then
+        self.cell = None
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_var_stmt(self)
 
-@dataclass(frozen=True)
+    def resolve(self, cell):
+        # the only place that writes to a node after parsing
+        self.cell = cell
+
 class While(Stmt):
-    condition: Expr
-    body: Stmt
+    __slots__ = ("condition", "body")
+    kind = WHILE_STMT
+
+    def __init__(self, condition: Expr, body: Stmt):
+        self.condition = condition
+        self.body = body
 
     def accept(self, visitor: VisitorStmt) -> Any:
         return visitor.visit_while_stmt(self)
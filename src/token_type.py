@@ -49,3 +49,10 @@ class TokenType(Enum):
     WHILE = auto()
 
     EOF = auto()
+
+
+# the value of every token type, also as a plain attribute. TokenBuffer stores
+# token types as these numbers, and the parser compares them a lot, reading
+# `.value` goes through a descriptor every time.
+for token_type in TokenType:
+    token_type.code = token_type.value
@@ -0,0 +1,460 @@
+from chunk import *
+from environment import Environment, Cell, UNDEFINED, capture, box
+from lox_runtime_error import LoxRuntimeError
+from lox_function import LoxFunction, LoxCallable
+from lox_class import LoxClass, LoxInstance
+from interpreter import Interpreter
+from bytecode_compiler import BytecodeCompiler
+from loop_optimizer import UNSET
+
+
+class VMFunction(LoxFunction):
+    def __init__(self, proto, upvalues, this=None):
+        super().__init__(proto.declaration, upvalues, proto.is_initializer, this)
+        self.proto = proto
+        self.chunk = proto.chunk
+        self.params = proto.params
+        self.cells = proto.declaration.cells
+
+    # only used when something outside of the vm dispatch loop calls us,
+    # calls from lox code are handled by OP_CALL without python recursion.
+    def call(self, interpreter, arguments):
+        if self.this is not None:
+            return self.call_method(interpreter, self.this, arguments)
+        values = list(arguments)
+        if self.cells:
+            box(values, self.cells)
+        return interpreter.run(self.chunk, Environment(values, self.upvalues))
+
+    def call_method(self, interpreter, instance, arguments):
+        values = [instance] # "this"
+        values.extend(arguments)
+        if self.cells:
+            box(values, self.cells)
+        return interpreter.run(self.chunk, Environment(values, self.upvalues))
+
+    def bind(self, instance):
+        return VMFunction(self.proto, self.upvalues, instance)
+
+    def arity(self):
+        return len(self.params)
+
+
+# stack based virtual machine. it is a drop-in replacement for the
+# tree-walking Interpreter and shares its globals and runtime helpers
+# (stringify, binary_operation, ...).
+class VM(Interpreter):
+    def interpret(self, syntax):
+        try:
+            chunk = BytecodeCompiler(self).compile_script(syntax)
+            value = self.run(chunk, self.globals_)
+            # REPL expression
+            if not isinstance(syntax, list):
+                return self.stringify(value)
+
+        except LoxRuntimeError as error:
+            self.runtime_error(error)
+            return None
+        finally:
+            self.output.flush()
+
+    def run(self, chunk, environment):
+        code = chunk.code
+        constants = chunk.constants
+        tokens = chunk.tokens
+        ip = 0
+        env = environment
+
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        # saved (code, constants, tokens, ip, env) of the callers
+        frames = []
+
+        globals_ = self.globals_.values
+        binary_operation = self.binary_operation
+        stringify = self.stringify
+        write_line = self.output.write_line
+
+        while True:
+            op = code[ip]
+            ip += 1
+
+            # roughly ordered by how often the instructions run.
+            if op == OP_GET_LOCAL:
+                push(env.values[code[ip]])
+                ip += 1
+
+            elif op == OP_CONSTANT:
+                push(constants[code[ip]])
+                ip += 1
+
+            elif op == OP_GET_GLOBAL:
+                value = globals_[code[ip]]
+                ip += 1
+                if value is UNDEFINED:
+                    token = tokens[ip - 2]
+                    raise LoxRuntimeError(token, f"Undefined variable '{token.lexeme}'.")
+                push(value)
+
+            elif op == OP_ADD:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a + b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_SUBTRACT:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a - b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_LESS:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a < b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_COMPARE_LOCAL:
+                value = env.values[code[ip]]
+                comparison = code[ip + 1]
+                constant = constants[code[ip + 2]]
+                ip += 3
+                if type(value) is not float:
+                    push(binary_operation(tokens[ip - 4], value, constant))
+                elif comparison == OP_LESS:
+                    push(value < constant)
+                elif comparison == OP_LESS_EQUAL:
+                    push(value <= constant)
+                elif comparison == OP_GREATER:
+                    push(value > constant)
+                else:
+                    push(value >= constant)
+
+            elif op == OP_INCREMENT_LOCAL:
+                slot = code[ip]
+                increment = constants[code[ip + 1]]
+                ip += 2
+                values = env.values
+                value = values[slot]
+                if type(value) is float:
+                    value += increment.step
+                else:
+                    value = binary_operation(tokens[ip - 3], value, increment.amount)
+                values[slot] = value
+                push(value)
+
+            elif op == OP_GET_MEMO:
+                value = env.values[code[ip]]
+                push(value)
+                if value is UNSET:
+                    ip += 2
+                else:
+                    ip = code[ip + 1]
+
+            elif op == OP_POP_JUMP_IF_FALSE:
+                value = pop()
+                if value is None or value is False:
+                    ip = code[ip]
+                else:
+                    ip += 1
+
+            elif op == OP_JUMP:
+                ip = code[ip]
+
+            elif op == OP_POP:
+                pop()
+
+            elif op == OP_SET_LOCAL:
+                env.values[code[ip]] = stack[-1]
+                ip += 1
+
+            elif op == OP_GET_UPVALUE:
+                push(env.upvalues[code[ip]].value)
+                ip += 1
+
+            elif op == OP_GET_CELL:
+                push(env.values[code[ip]].value)
+                ip += 1
+
+            elif op == OP_SET_UPVALUE:
+                env.upvalues[code[ip]].value = stack[-1]
+                ip += 1
+
+            elif op == OP_SET_CELL:
+                env.values[code[ip]].value = stack[-1]
+                ip += 1
+
+            elif op == OP_GET_METHOD:
+                get = constants[code[ip]]
+                ip += 1
+                obj = stack[-1]
+                method = None
+                if isinstance(obj, LoxInstance):
+                    method = get.cache.method_of(obj, get.name)
+                if method is not None:
+                    stack[-1] = method
+                    push(obj)
+                else:
+                    # a field or not an instance at all
+                    stack[-1] = self.get_property(get, obj)
+                    push(None)
+
+            elif op == OP_CALL or op == OP_INVOKE:
+                argc = code[ip]
+                ip += 1
+                offset = ip - 2 # of this instruction, for tokens
+                # `this` is set when we call a method without binding it
+                # first. `below` is the number of stack slots under the
+                # arguments that belong to the call.
+                if op == OP_CALL:
+                    callee = stack[-1 - argc]
+                    this = None
+                    below = 1
+                else:
+                    callee = stack[-2 - argc]
+                    this = stack[-1 - argc]
+                    below = 2
+
+                if isinstance(callee, LoxClass):
+                    this = LoxInstance(callee)
+                    if callee.initializer is None:
+                        if argc != 0:
+                            raise LoxRuntimeError(tokens[offset], f"Expected 0 arguments but got {argc}.")
+                        del stack[len(stack) - below:]
+                        push(this)
+                        continue
+                    callee = callee.initializer
+
+                if type(callee) is VMFunction:
+                    params = callee.params
+                    if argc != len(params):
+                        raise LoxRuntimeError(tokens[offset], f"Expected {len(params)} arguments but got {argc}.")
+                    if callee.this is not None:
+                        this = callee.this
+                    start = len(stack) - argc
+                    # params take the first slots of the call environment,
+                    # after "this" for methods
+                    if this is None:
+                        values = stack[start:]
+                    else:
+                        values = [this]
+                        values += stack[start:]
+                    del stack[start - below:]
+                    if callee.cells:
+                        box(values, callee.cells)
+                    callee_env = Environment(values, callee.upvalues)
+
+                    frames.append((code, constants, tokens, ip, env))
+                    chunk = callee.chunk
+                    code = chunk.code
+                    constants = chunk.constants
+                    tokens = chunk.tokens
+                    ip = 0
+                    env = callee_env
+                    continue
+
+                if not isinstance(callee, LoxCallable):
+                    raise LoxRuntimeError(tokens[offset], "Can only call functions and classes.")
+                if argc != callee.arity():
+                    raise LoxRuntimeError(tokens[offset], f"Expected {callee.arity()} arguments but got {argc}.")
+                start = len(stack) - argc
+                arguments = stack[start:]
+                del stack[start - below:]
+                push(callee.call(self, arguments))
+
+            elif op == OP_RETURN:
+                value = pop()
+                if not frames:
+                    return value
+                code, constants, tokens, ip, env = frames.pop()
+                push(value)
+
+            elif op == OP_GET_PROPERTY:
+                get = constants[code[ip]]
+                ip += 1
+                obj = stack[-1]
+                cache = get.cache
+                if isinstance(obj, LoxInstance) and cache.shape is obj.shape and cache.index is not None:
+                    # cache hit on a field
+                    stack[-1] = obj.values[cache.index]
+                else:
+                    stack[-1] = self.get_property(get, obj)
+
+            elif op == OP_SET_PROPERTY:
+                set_ = constants[code[ip]]
+                ip += 1
+                value = pop()
+                # OP_CHECK_INSTANCE made sure it's an instance
+                set_.cache.set(stack[-1], set_.name, value)
+                stack[-1] = value
+
+            elif op == OP_CHECK_INSTANCE:
+                if not isinstance(stack[-1], LoxInstance):
+                    raise LoxRuntimeError(constants[code[ip]].name, "Only instances have fields.")
+                ip += 1
+
+            # blocks at the top level, the only ones with an environment
+            elif op == OP_PUSH_SCOPE:
+                env = Environment([])
+
+            elif op == OP_POP_SCOPE:
+                env = self.globals_
+
+            elif op == OP_TRUNCATE:
+                del env.values[code[ip]:]
+                ip += 1
+
+            elif op == OP_DEFINE_LOCAL:
+                env.values.append(pop())
+
+            elif op == OP_DEFINE_CELL:
+                env.values.append(Cell(pop()))
+
+            elif op == OP_NEW_CELL:
+                cell = Cell(None)
+                env.values.append(cell)
+                push(cell)
+
+            elif op == OP_FILL_CELL:
+                value = pop()
+                pop().value = value
+
+            elif op == OP_DEFINE_GLOBAL:
+                globals_[code[ip]] = pop()
+                ip += 1
+
+            elif op == OP_SET_GLOBAL:
+                slot = code[ip]
+                ip += 1
+                if globals_[slot] is UNDEFINED:
+                    token = tokens[ip - 2]
+                    raise LoxRuntimeError(token, f"Undefined variable '{token.lexeme}'.")
+                globals_[slot] = stack[-1]
+
+            elif op == OP_NIL:
+                push(None)
+
+            elif op == OP_TRUE:
+                push(True)
+
+            elif op == OP_FALSE:
+                push(False)
+
+            elif op == OP_EQUAL:
+                b = pop()
+                stack[-1] = stack[-1] == b
+
+            elif op == OP_NOT_EQUAL:
+                b = pop()
+                stack[-1] = stack[-1] != b
+
+            elif op == OP_GREATER:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a > b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_GREATER_EQUAL:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a >= b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_LESS_EQUAL:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a <= b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_MULTIPLY:
+                b = pop()
+                a = stack[-1]
+                if type(a) is float and type(b) is float:
+                    stack[-1] = a * b
+                else:
+                    stack[-1] = binary_operation(tokens[ip - 1], a, b)
+
+            elif op == OP_DIVIDE:
+                b = pop()
+                stack[-1] = binary_operation(tokens[ip - 1], stack[-1], b)
+
+            elif op == OP_NOT:
+                value = stack[-1]
+                stack[-1] = value is None or value is False
+
+            elif op == OP_NEGATE:
+                value = stack[-1]
+                if type(value) is not float:
+                    raise LoxRuntimeError(tokens[ip - 1], "Operand must be a number.")
+                stack[-1] = -value
+
+            elif op == OP_PRINT:
+                write_line(stringify(pop()))
+
+            elif op == OP_JUMP_IF_FALSE:
+                value = stack[-1]
+                if value is None or value is False:
+                    ip = code[ip]
+                else:
+                    ip += 1
+
+            elif op == OP_JUMP_IF_TRUE:
+                value = stack[-1]
+                if value is None or value is False:
+                    ip += 1
+                else:
+                    ip = code[ip]
+
+            elif op == OP_GET_SUPER:
+                superclass = env.upvalues[code[ip]].value
+                method_token = constants[code[ip + 1]]
+                ip += 2
+                method = superclass.find_method(method_token.lexeme)
+                if method is None:
+                    raise LoxRuntimeError(method_token,
+                                          "Undefined property '" + method_token.lexeme + "'.")
+                stack[-1] = method.bind(stack[-1]) # "this"
+
+            elif op == OP_CLOSURE:
+                proto = constants[code[ip]]
+                push(VMFunction(proto, capture(env, proto.declaration.upvalues)))
+                ip += 1
+
+            elif op == OP_CLASS:
+                proto = constants[code[ip]]
+                ip += 1
+                declaration = proto.declaration
+
+                superclass = None
+                if declaration.superclass is not None:
+                    superclass = pop()
+                    if not isinstance(superclass, LoxClass):
+                        raise LoxRuntimeError(tokens[ip - 2], "Superclass must be a name.")
+
+                method_env = env
+                if superclass is not None:
+                    method_env = Environment([Cell(superclass)],
+                                             capture(env, declaration.upvalues))
+
+                methods = {}
+                for method in proto.methods:
+                    methods[method.declaration.name.lexeme] = VMFunction(
+                        method, capture(method_env, method.declaration.upvalues))
+
+                push(LoxClass(declaration.name.lexeme, superclass, methods))
+
+            else:
+                raise RuntimeError(f"Unknown opcode {op}.")
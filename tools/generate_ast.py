@@ -1,42 +1,91 @@
 import sys
 from pathlib import Path
 
-def define_ast(output_dir, base_name, types):
+# node classes are plain classes with __slots__ (no dataclasses): creating a
+# node is a simple __init__ and a node has no __dict__, which matters for big
+# trees that stay around while the program runs.
+#
+# every node class also gets an integer `kind` (and a constant for it, like
+# ASSIGN_EXPR), for code that wants to dispatch on the node type without a
+# visitor. `first_kind` keeps the numbers of Expr and Stmt nodes apart.
+def define_ast(output_dir, base_name, types, first_kind=0):
     file_path = Path(f"{output_dir}/{base_name.lower()}.py")
     with open(file_path, "w", encoding="utf-8") as file:
         file.write("from abc import ABC, abstractmethod\n"
-                   "from dataclasses import dataclass\n"
                    "from typing import Any\n"
                    "from lox_token import Token\n\n")
         define_visitor(file, base_name, types)
+        define_kinds(file, base_name, types, first_kind)
         file.write(f"class {base_name}(ABC):\n")
+        file.write(f"    __slots__ = ()\n\n")
         file.write(f"    @abstractmethod\n")
         file.write(f"    def accept(self, visitor: Visitor{base_name}) -> Any:\n")
         file.write(f"        pass\n\n")
+        file.write(f"    def __repr__(self):\n")
+        file.write(f"        fields = \", \".join(f\"{{name}}={{getattr(self, name)!r}}\" for name in self.__slots__)\n")
+        file.write(f"        return f\"{{type(self).__name__}}({{fields}})\"\n\n")
 
 
         for typ in types:
             class_name = typ.split(":")[0].strip()
             fields = typ.split(":")[1].strip()
-            define_type(file, base_name, class_name, fields)
+            # fields after `|` are not set by the parser but filled in later by the resolver
+            resolved_fields = ""
+            if "|" in fields:
+                fields, resolved_fields = [f.strip() for f in fields.split("|")]
+            define_type(file, base_name, class_name, fields, resolved_fields)
 
-def define_type(file, base_name, class_name, field_list):
-    file.write("@dataclass(frozen=True)\n")
+def split_fields(field_list):
+    if not field_list:
+        return []
+    return [f.strip() for f in field_list.split(",")]
+
+def kind_name(class_name, base_name):
+    return f"{class_name.upper()}_{base_name.upper()}"
+
+def define_kinds(file, base_name, types, first_kind):
+    file.write(f"# `kind` of each {base_name} node class\n")
+    for kind, typ in enumerate(types, first_kind):
+        class_name = typ.split(":")[0].strip()
+        file.write(f"{kind_name(class_name, base_name)} = {kind}\n")
+    file.write("\n")
+
+def define_type(file, base_name, class_name, field_list, resolved_list=""):
     file.write(f"class {class_name}({base_name}):\n")
 
-    if not field_list:
-        fields = []
-    else:
-        fields = [f.strip() for f in field_list.split(",")]
+    fields = split_fields(field_list)
+    resolved_fields = split_fields(resolved_list)
+    names = [field.split(" ")[0] for field in fields]
+    resolved_names = [field.split(" ")[0] for field in resolved_fields]
+
+    slots = ", ".join(f"\"{name}\"" for name in names + resolved_names)
+    if len(names + resolved_names) == 1:
+        slots += ","
+    file.write(f"    __slots__ = ({slots})\n")
+    file.write(f"    kind = {kind_name(class_name, base_name)}\n\n")
 
-    for field in fields:
-        name = field.split(" ")[0]
-        typ = field.split(" ")[1]
-        file.write(f"    {name}: {typ}\n")
+    params = "".join(f", {field.split(' ')[0]}: {field.split(' ')[1]}" for field in fields)
+    file.write(f"    def __init__(self{params}):\n")
+    for name in names:
+        file.write(f"        self.{name} = {name}\n")
+    if resolved_fields:
+        file.write("        # filled in by the resolver, None until then\n")
+    for name in resolved_names:
+        file.write(f"        self.{name} = None\n")
+    if not names and not resolved_names:
+        file.write("        pass\n")
     file.write("\n")
+
     file.write(f"    def accept(self, visitor: Visitor{base_name}) -> Any:\n")
     file.write(f"        return visitor.visit_{class_name.lower()}_{base_name.lower()}(self)\n\n")
 
+    if resolved_fields:
+        file.write(f"    def resolve(self, {', '.join(resolved_names)}):\n")
+        file.write(f"        # the only place that writes to a node after parsing\n")
+        for name in resolved_names:
+            file.write(f"        self.{name} = {name}\n")
+        file.write("\n")
+
 def define_visitor(file, base_name, types):
     file.write(f"class Visitor{base_name}(ABC):\n")
     for typ in types:
@@ -55,32 +104,35 @@ def main():
         output_dir = args[0]
         
         define_ast(output_dir, "Expr", [
-                   "Assign   : name Token, value Expr",
-                   "Binary   : left Expr, operator Token, right Expr",
+                   "Assign   : name Token, value Expr | scope int, slot int",
+                   "Binary   : left Expr, operator Token, right Expr | cache Any",
                    "Call     : callee Expr, paren Token, arguments list[Expr]",
-                   "Get      : object Expr, name Token",
+                   "Compare  : name Token, operator Token, constant float | scope int, slot int",
+                   "Get      : object Expr, name Token | cache Any",
                    "Grouping : expression Expr",
+                   "Increment: name Token, operator Token, amount float, step float | scope int, slot int",
                    "Literal  : value Any",
                    "Logical  : left Expr, operator Token, right Expr",
-                   "Set      : object Expr, name Token, value Expr",
-                   "Super    : keyword Token, method Token",
-                   "This     : keyword Token",
+                   "Memo     : expression Expr, name Token | scope int, slot int",
+                   "Set      : object Expr, name Token, value Expr | cache Any",
+                   "Super    : keyword Token, method Token | upvalue int, this Any",
+                   "This     : keyword Token | scope int, slot int",
                    "Unary    : operator Token, right Expr",
-                   "Variable : name Token",
+                   "Variable : name Token | scope int, slot int",
                    ])
 
         define_ast(output_dir, "Stmt", [
-            "Block      : statements list[Stmt]",
+            "Block      : statements list[Stmt] | inline bool, start int",
             "Break      : ",
-            "Class      : name Token, superclass Variable,methods list['Function']",
+            "Class      : name Token, superclass Variable,methods list['Function'] | cell bool, upvalues list",
             "Expression : expression Expr",
-            "Function   : name Token, params list[Token], body list[Stmt]",
+            "Function   : name Token, params list[Token], body list[Stmt] | cell bool, upvalues list, cells list",
             "If         : condition Expr, then_branch Stmt, else_branch Stmt",
             "Print      : expression Expr",
-            "Return     : keyword Token, value Expr",
-            "Var        : name Token, initializer Expr",
+            "Return     : keyword Token, value Expr | tail_call bool",
+            "Var        : name Token, initializer Expr | cell bool",
             "While      : condition Expr, body Stmt",
-        ])
+        ], first_kind=100)
 
 if __name__ == "__main__": 
     main()